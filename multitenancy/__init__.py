@@ -1,3 +1,5 @@
 "Host multiple RapidSMS instances in one project"
 
 __version__ = '0.2.0'
+
+default_app_config = 'multitenancy.apps.MultitenancyConfig'
@@ -1,14 +1,20 @@
 from django import forms
+from django.conf.urls import url
 from django.contrib import admin
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, JsonResponse
+from django.utils.encoding import force_text
 from django.utils.translation import ugettext_lazy as _
 
-from .forms import TenantForm
+from .auth import filter_permitted, get_user_group_ids
+from .forms import TenantForm, TenantFormSet, get_backend_link_queryset
 from .models import BackendLink, ContactLink, Tenant, TenantGroup, TenantRole
 
 
 class TenantInline(admin.TabularInline):
     extra = 1
     form = TenantForm
+    formset = TenantFormSet
     model = Tenant
     prepopulated_fields = {"slug": ("name", )}
 
@@ -67,10 +73,7 @@ class TenantGroupAdmin(admin.ModelAdmin):
     def get_queryset(self, request):
         """Limit to TenantGroups that this user can access."""
         qs = super(TenantGroupAdmin, self).get_queryset(request)
-        if not request.user.is_superuser:
-            qs = qs.filter(tenantrole__user=request.user,
-                           tenantrole__role=TenantRole.ROLE_GROUP_MANAGER)
-        return qs
+        return filter_permitted(request.user, 'multitenancy.change_tenantgroup', qs)
 
     def get_inline_instances(self, request, obj=None):
         if request.user.is_superuser:
@@ -116,30 +119,64 @@ class TenantAdmin(admin.ModelAdmin):
     inlines = (TenantManagerInline, )
     list_display = ('name', 'group', 'slug', 'get_backend_names', )
     list_filter = ('group', )
+    list_select_related = ('group', )
     prepopulated_fields = {"slug": ("name", )}
     search_fields = ('name', )
+    # number of results per page of the backend link search
+    backend_links_per_page = 20
 
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
         if db_field.rel.to == TenantGroup and not request.user.is_superuser:
             qs = kwargs.pop('queryset', TenantGroup.objects.all())
-            qs = qs.filter(tenantrole__user=request.user)
+            qs = qs.filter(pk__in=get_user_group_ids(request.user))
             kwargs['queryset'] = qs
         return super(TenantAdmin, self).formfield_for_foreignkey(db_field, request, **kwargs)
 
     def get_queryset(self, request):
-        """Limit to Tenants that this user can access."""
-        qs = super(TenantAdmin, self).get_queryset(request)
-        if not request.user.is_superuser:
-            tenants_by_group_manager_role = qs.filter(
-                group__tenantrole__user=request.user,
-                group__tenantrole__role=TenantRole.ROLE_GROUP_MANAGER
-            )
-            tenants_by_tenant_manager_role = qs.filter(
-                tenantrole__user=request.user,
-                tenantrole__role=TenantRole.ROLE_TENANT_MANAGER
-            )
-            return tenants_by_group_manager_role | tenants_by_tenant_manager_role
-        return qs
+        """
+        Limit to Tenants that this user can access. The ids of the user's groups and
+        tenants come from their roles, so this doesn't join against TenantRole.
+        """
+        qs = super(TenantAdmin, self).get_queryset(request).with_backends()
+        return filter_permitted(request.user, 'multitenancy.change_tenant', qs)
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        urlpatterns = [
+            url(r'^backend-links/$', self.admin_site.admin_view(self.backend_links_view),
+                name='%s_%s_backend_links' % info),
+        ]
+        return urlpatterns + list(super(TenantAdmin, self).get_urls())
+
+    def backend_links_view(self, request):
+        """
+        Search the BackendLinks which may be chosen for a tenant, for the TenantForm's
+        BackendLinkLookupWidget. Takes the tenant's id (if it exists already), a search
+        term and a page number, and returns a page of matching links as JSON.
+        """
+        if not (self.has_add_permission(request) or self.has_change_permission(request)):
+            raise PermissionDenied
+        tenant = None
+        if request.GET.get('tenant'):
+            tenant = self.get_object(request, request.GET['tenant'])
+            if tenant is None:
+                raise Http404('No Tenant matches the given query.')
+        links = get_backend_link_queryset(tenant).select_related('backend')
+        term = request.GET.get('q', '').strip()
+        if term:
+            links = links.filter(backend__name__icontains=term)
+        try:
+            page = max(int(request.GET.get('page', 1)), 1)
+        except ValueError:
+            page = 1
+        start = (page - 1) * self.backend_links_per_page
+        # fetch one more than needed to know if there is a next page, without counting
+        results = list(links.order_by('backend__name')[start:start + self.backend_links_per_page + 1])
+        return JsonResponse({
+            'results': [{'id': link.pk, 'text': force_text(link)}
+                        for link in results[:self.backend_links_per_page]],
+            'more': len(results) > self.backend_links_per_page,
+        })
 
 admin.site.register(BackendLink)
 admin.site.register(ContactLink)
@@ -0,0 +1,25 @@
+from rapidsms.apps.base import AppBase
+
+from .routing import routing_table
+
+
+class TenantApp(AppBase):
+    """
+    Tags incoming messages with the tenant of the backend they arrived on.
+
+    After the filter phase, every message has ``tenant_id`` and ``tenant`` attributes
+    (None if the backend isn't linked to a tenant), resolved from the routing table
+    so that handlers don't need to query for them. List multitenancy before any
+    apps whose filter phase needs the tenant.
+
+    The router runs in its own process, so set MULTITENANCY_CACHE to see backends
+    linked elsewhere right away. Otherwise the routing table is only rebuilt every
+    MULTITENANCY_LOCAL_CACHE_TIMEOUT seconds.
+    """
+
+    def filter(self, msg):
+        tenant_id = None
+        if msg.connections:
+            tenant_id = routing_table.get_tenant_id(backend_id=msg.connections[0].backend_id)
+        msg.tenant_id = tenant_id
+        msg.tenant = routing_table.get_tenant(tenant_id) if tenant_id is not None else None
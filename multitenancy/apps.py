@@ -0,0 +1,14 @@
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class MultitenancyConfig(AppConfig):
+    name = 'multitenancy'
+    verbose_name = 'Multitenancy'
+
+    def ready(self):
+        # Connect the signal handlers which keep our caches up to date
+        from . import signals  # noqa
+        if getattr(settings, 'MULTITENANCY_SYNC_BACKEND_LINKS', False):
+            from .sync import sync_installed_backends
+            sync_installed_backends()
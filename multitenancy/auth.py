@@ -1,7 +1,13 @@
+import functools
+
 from django.apps import apps
+from django.conf import settings
 from django.db import models
 
+from .cache import get_cache, get_version, make_key
 from .models import TenantRole, TenantGroup, Tenant
+from .registry import registry
+from .utils import LRUCache
 
 
 def get_user_groups(user):
@@ -10,49 +16,296 @@ def get_user_groups(user):
         if user.is_superuser:
             return TenantGroup.objects.all()
         else:
-            return TenantGroup.objects.filter(tenantrole__user=user).distinct()
+            return TenantGroup.objects.filter(pk__in=get_role_index(user).group_ids)
     else:
         return TenantGroup.objects.none()
 
 
+def get_user_group_ids(user):
+    """
+    Return the set of ids of the associated TenantGroups for the given user.
+
+    Only superusers need a query; for everyone else the ids come from their roles.
+    """
+    if user.is_active and user.is_authenticated():
+        if user.is_superuser:
+            return frozenset(TenantGroup.objects.values_list('pk', flat=True))
+        else:
+            return get_role_index(user).group_ids
+    else:
+        return frozenset()
+
+
 def get_user_tenants(user, group):
     """Return the set of associated Tenants for the given user and group."""
     if user.is_active and user.is_authenticated():
         if user.is_superuser or is_group_manager(user, group.pk):
             return Tenant.objects.filter(group=group)
         else:
-            return Tenant.objects.filter(group=group, tenantrole__user=user).distinct()
+            return Tenant.objects.filter(group=group, pk__in=get_role_index(user).tenants_in_group(group.pk))
     else:
         return Tenant.objects.none()
 
 
+def get_user_tenant_ids(user, group):
+    """
+    Return the set of ids of the associated Tenants for the given user and group.
+
+    Only superusers and group managers need a query; for tenant managers the
+    ids come from their roles.
+    """
+    if user.is_active and user.is_authenticated():
+        if user.is_superuser or is_group_manager(user, group.pk):
+            return frozenset(Tenant.objects.filter(group=group).values_list('pk', flat=True))
+        else:
+            return get_role_index(user).tenants_in_group(group.pk)
+    else:
+        return frozenset()
+
+
+def can_access_group(user, group_id):
+    """
+    Return True if the group is one of the user's groups (see get_user_groups).
+
+    Needs no queries: superusers can access every existing group and everyone
+    else's groups come from their roles.
+    """
+    if not (user.is_active and user.is_authenticated()):
+        return False
+    return user.is_superuser or group_id in get_role_index(user).group_ids
+
+
+def can_access_tenant(user, tenant):
+    """Return True if the tenant is one of the user's tenants (see get_user_tenants), without queries."""
+    if not (user.is_active and user.is_authenticated()):
+        return False
+    if user.is_superuser or is_group_manager(user, tenant.group_id):
+        return True
+    return tenant.pk in get_role_index(user).tenants_in_group(tenant.group_id)
+
+
+def role_version_name(user_id):
+    """Name of the version which is bumped whenever the user's roles change."""
+    return 'roles:{}'.format(user_id)
+
+
+def get_role_version(user):
+    """Return the current version of the user's roles, looked up once per request."""
+    if not hasattr(user, '_role_version'):
+        user._role_version = get_version(role_version_name(user.pk))
+    return user._role_version
+
+
+def _load_user_roles(user):
+    cache = get_cache()
+    if cache is None or user.pk is None:
+        return list(TenantRole.objects.filter(user=user).values_list('group', 'role', 'tenant'))
+    version = get_role_version(user)
+    key = make_key('roles', user.pk, version)
+    roles = cache.get(key)
+    if roles is None:
+        roles = list(TenantRole.objects.filter(user=user).values_list('group', 'role', 'tenant'))
+        timeout = getattr(settings, 'MULTITENANCY_ROLE_CACHE_TIMEOUT', 300)
+        cache.set(key, roles, timeout)
+    return roles
+
+
 def get_user_roles(user):
-    """Return a list of all of the user's roles."""
+    """
+    Return a list of all of the user's roles.
+
+    The roles are kept on the user object for the rest of the request and, if
+    MULTITENANCY_CACHE is set, in the shared cache between requests.
+    """
     if not hasattr(user, '_role_cache'):
-        user._role_cache = list(TenantRole.objects.filter(user=user).values_list(
-            'group', 'role', 'tenant'))
+        user._role_cache = _load_user_roles(user)
     return user._role_cache
 
 
+class RoleIndex(object):
+    """Set based lookups over a list of (group, role, tenant) role tuples."""
+
+    __slots__ = ('managed_groups', 'managed_tenants', 'tenant_groups', 'tenant_ids', 'group_ids',
+                 'any_group_manager', 'any_tenant_manager', '_tenants_by_group')
+
+    def __init__(self, roles):
+        self.managed_groups = frozenset(
+            group for group, role, tenant in roles if role == TenantRole.ROLE_GROUP_MANAGER)
+        # (group, tenant) pairs for which the user is a tenant manager
+        self.managed_tenants = frozenset(
+            (group, tenant) for group, role, tenant in roles if role == TenantRole.ROLE_TENANT_MANAGER)
+        self.tenant_groups = frozenset(group for group, tenant in self.managed_tenants)
+        self.tenant_ids = frozenset(tenant for group, tenant in self.managed_tenants)
+        # Every group the user has any role in
+        self.group_ids = frozenset(group for group, role, tenant in roles)
+        tenants_by_group = {}
+        for group, tenant in self.managed_tenants:
+            tenants_by_group.setdefault(group, set()).add(tenant)
+        self._tenants_by_group = dict((g, frozenset(t)) for g, t in tenants_by_group.items())
+        self.any_group_manager = bool(self.managed_groups)
+        self.any_tenant_manager = bool(self.managed_tenants)
+
+    def is_group_manager(self, group=None):
+        if not group:
+            return self.any_group_manager
+        return group in self.managed_groups
+
+    def is_tenant_manager(self, group=None, tenant=None):
+        if group and tenant:
+            return (group, tenant) in self.managed_tenants
+        elif group:
+            return group in self.tenant_groups
+        elif tenant:
+            return tenant in self.tenant_ids
+        return self.any_tenant_manager
+
+    def tenants_in_group(self, group):
+        """Return the ids of the tenants of group which the user is a tenant manager for."""
+        return self._tenants_by_group.get(group, frozenset())
+
+
+def get_role_index(user):
+    """Return the RoleIndex for the user's roles, built once per request."""
+    # Compare by identity so the index is rebuilt if the roles are reloaded
+    if getattr(user, '_role_index_roles', None) is not get_user_roles(user):
+        user._role_index = RoleIndex(user._role_cache)
+        user._role_index_roles = user._role_cache
+    return user._role_index
+
+
 def is_group_manager(user, group=None):
     """Returns True if user is a group manager either for the group or any group."""
-    roles = get_user_roles(user)
-    return any(x[1] == TenantRole.ROLE_GROUP_MANAGER and (not group or x[0] == group) for x in roles)
+    return get_role_index(user).is_group_manager(group)
 
 
 def is_tenant_manager(user, group=None, tenant=None):
     """Returns True if user is a tenant manager either for the group/tenant or any group/tenant."""
-    roles = get_user_roles(user)
-    return any(
-        x[1] == TenantRole.ROLE_TENANT_MANAGER and
-        (not group or x[0] == group) and
-        (not tenant or x[2] == tenant)
-        for x in roles
-    )
+    return get_role_index(user).is_tenant_manager(group, tenant)
+
+
+_object_resolvers = {}
+
+
+def _resolve_group(obj):
+    return obj.pk, None
+
+
+def _resolve_tenant(obj):
+    return obj.group_id, obj.pk
+
+
+def _resolve_fields(group_attname, tenant_attname, obj):
+    group = getattr(obj, group_attname) if group_attname else None
+    tenant = getattr(obj, tenant_attname) if tenant_attname else None
+    if tenant:
+        group = registry.get_tenant_group_id(tenant)
+    return group, tenant
+
+
+def _tenant_fields(model):
+    """Return the ForeignKeys of model to (TenantGroup, Tenant). Either may be None."""
+    group_field = tenant_field = None
+    for field in model._meta.fields:
+        if isinstance(field, models.ForeignKey):
+            if field.rel.to == TenantGroup:
+                group_field = field
+            elif field.rel.to == Tenant:
+                tenant_field = field
+    return group_field, tenant_field
+
+
+def get_object_resolver(model):
+    """
+    Return a function which takes an instance of model and returns the ids of
+    the (group, tenant) it belongs to. Either may be None.
+
+    The model's fields are only inspected once; the group of a tenant comes from
+    the TenantRegistry rather than by loading the related Tenant.
+    """
+    try:
+        return _object_resolvers[model]
+    except KeyError:
+        pass
+    if issubclass(model, TenantGroup):
+        resolver = _resolve_group
+    elif issubclass(model, Tenant):
+        resolver = _resolve_tenant
+    else:
+        group_field, tenant_field = _tenant_fields(model)
+        resolver = functools.partial(_resolve_fields,
+                                     group_field and group_field.get_attname(),
+                                     tenant_field and tenant_field.get_attname())
+    _object_resolvers[model] = resolver
+    return resolver
+
+
+MULTITENANCY_MODELS = (TenantGroup, Tenant, TenantRole)
+
+_permission_cache = LRUCache(max_size=256)
+
+
+def parse_permission(perm):
+    """
+    Return (action, model, is_multitenancy_model) for a permission string such as
+    'multitenancy.change_tenant'. Results are kept in a bounded LRU cache.
+    """
+    parsed = _permission_cache.get(perm)
+    if parsed is None:
+        app_label, permission_label = perm.split('.', 1)
+        action, model_label = permission_label.split('_', 1)
+        model = apps.get_model(app_label, model_label)
+        parsed = (action, model, model in MULTITENANCY_MODELS)
+        _permission_cache.set(perm, parsed)
+    return parsed
+
+
+_related_apps = {}
+
+
+def is_related_app(app_label):
+    """Returns True if the app contains any of the multitenancy models."""
+    try:
+        return _related_apps[app_label]
+    except KeyError:
+        config = apps.get_app_config(app_label)
+        related = any(m in MULTITENANCY_MODELS for m in config.get_models())
+        _related_apps[app_label] = related
+        return related
+
+
+_decision_cache = None
+
+
+def get_decision_cache():
+    """
+    Return the per-process LRU cache of permission decisions, or None if it is
+    disabled (MULTITENANCY_PERMISSION_CACHE_SIZE is 0, the default).
+    """
+    global _decision_cache
+    size = getattr(settings, 'MULTITENANCY_PERMISSION_CACHE_SIZE', 0)
+    if not size:
+        return None
+    if _decision_cache is None:
+        timeout = getattr(settings, 'MULTITENANCY_PERMISSION_CACHE_TIMEOUT', 60)
+        _decision_cache = LRUCache(max_size=size, timeout=timeout)
+    return _decision_cache
+
+
+def reset_decision_cache():
+    """Drop the decision cache, so it is recreated with the current settings."""
+    global _decision_cache
+    _decision_cache = None
 
 
 class TenantRolesBackend(object):
-    """Custom authentication backend to handle role-based permissions. """
+    """
+    Custom authentication backend to handle role-based permissions.
+
+    Decisions can be cached per process by setting MULTITENANCY_PERMISSION_CACHE_SIZE.
+    Cached decisions are keyed on the version of the user's roles and of the tenant
+    registry, and on the group and tenant the object belongs to, so changes to roles,
+    tenants or the object's tenant are picked up immediately.
+    """
 
     def authenticate(self, *args, **kwargs):  # pragma: no cover
         """Dummy method, required for all auth backends."""
@@ -69,10 +322,29 @@ class TenantRolesBackend(object):
         if user.is_superuser:
             return True
 
-        app_label, permission_label = perm.split('.', 1)
-        action, model_label = permission_label.split('_', 1)
-        model = apps.get_model(app_label, model_label)
+        cache = get_decision_cache()
+        if cache is None or user.pk is None or (obj is not None and obj.pk is None):
+            return self._has_perm(user, perm, obj)
+        if obj is None:
+            obj_key = None
+        else:
+            # The decision depends on the group and tenant the object currently
+            # belongs to, which may change without its pk changing
+            obj_key = (obj._meta.app_label, obj._meta.model_name, obj.pk) + get_object_resolver(type(obj))(obj)
+        if not hasattr(user, '_registry_version'):
+            user._registry_version = get_version(registry.version_name)
+        key = (user.pk, get_role_version(user), user._registry_version, perm, obj_key)
+        result = cache.get(key)
+        if result is None:
+            result = self._has_perm(user, perm, obj)
+            cache.set(key, result)
+        return result
+
+    def _has_perm(self, user, perm, obj):
+        action, model, multitenancy_model = parse_permission(perm)
         if obj is None:
+            if not multitenancy_model:
+                return False
             group_manager = is_group_manager(user)
             tenant_manager = is_tenant_manager(user)
             if model == TenantGroup:
@@ -82,23 +354,7 @@ class TenantRolesBackend(object):
             elif model == TenantRole:
                 return group_manager
         else:
-            group = None
-            tenant = None
-            if isinstance(obj, TenantGroup):
-                group = obj.pk
-            elif isinstance(obj, Tenant):
-                tenant = obj.pk
-                group = obj.group_id
-            else:
-                # Check if object has FK to group or tenant
-                for field in obj.__class__._meta.fields:
-                    if isinstance(field, models.ForeignKey):
-                        if field.rel.to == TenantGroup:
-                            group = getattr(obj, field.get_attname())
-                        elif field.rel.to == Tenant:
-                            tenant = getattr(obj, field.get_attname())
-                            if getattr(obj, field.name):
-                                group = getattr(obj, field.name).group_id
+            group, tenant = get_object_resolver(type(obj))(obj)
             group_manager = is_group_manager(user, group=group)
             tenant_manager = is_tenant_manager(user, group=group, tenant=tenant)
             if tenant:
@@ -117,10 +373,57 @@ class TenantRolesBackend(object):
         if user.is_superuser:
             return True
 
-        config = apps.get_app_config(app_label)
-        group_manager = is_group_manager(user)
-        tenant_manager = is_tenant_manager(user)
-        related = any(
-            m in (TenantGroup, Tenant, TenantRole)
-            for m in config.get_models())
-        return (group_manager or tenant_manager) and related
+        if not is_related_app(app_label):
+            return False
+        return is_group_manager(user) or is_tenant_manager(user)
+
+
+def get_permitted_q(model, user):
+    """
+    Return a Q object matching the instances of model which the (active, non
+    superuser) user has object permissions for through their roles.
+
+    This mirrors the object checks of TenantRolesBackend.has_perm.
+    """
+    index = get_role_index(user)
+    if issubclass(model, TenantGroup):
+        return models.Q(pk__in=index.managed_groups)
+    elif issubclass(model, Tenant):
+        return models.Q(group__in=index.managed_groups) | models.Q(pk__in=index.tenant_ids)
+    group_field, tenant_field = _tenant_fields(model)
+    if tenant_field is not None:
+        tenant_q = (models.Q(**{tenant_field.name + '__group__in': index.managed_groups}) |
+                    models.Q(**{tenant_field.name + '__in': index.tenant_ids}))
+        if group_field is None:
+            return tenant_q
+        # Objects without a tenant fall back to checking their group
+        group_q = models.Q(**{group_field.name + '__in': index.managed_groups})
+        return ((models.Q(**{tenant_field.name + '__isnull': False}) & tenant_q) |
+                (models.Q(**{tenant_field.name + '__isnull': True}) & group_q))
+    elif group_field is not None:
+        return models.Q(**{group_field.name + '__in': index.managed_groups})
+    return None
+
+
+def filter_permitted(user, perm, queryset):
+    """
+    Narrow queryset to the objects for which TenantRolesBackend grants the user
+    perm, in a single query.
+
+    As with has_perm, object permissions granted through roles don't depend on the
+    action of perm, only on the group and tenant of each object.
+    """
+    if not user.is_active:
+        return queryset.none()
+    if user.is_superuser:
+        return queryset
+    q = get_permitted_q(queryset.model, user)
+    if q is None:
+        return queryset.none()
+    return queryset.filter(q)
+
+
+def has_perms_for_objects(user, perm, objs):
+    """Return a dict mapping each of objs to whether TenantRolesBackend grants the user perm."""
+    backend = TenantRolesBackend()
+    return dict((obj, backend.has_perm(user, perm, obj)) for obj in objs)
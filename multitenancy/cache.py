@@ -0,0 +1,117 @@
+"""
+Helpers for the optional shared cache used by multitenancy.
+
+Set ``MULTITENANCY_CACHE`` to the alias of one of your ``CACHES`` to share
+cached tenant data between processes. Without it, everything is cached
+per-process and only invalidated by signals sent in that same process.
+"""
+from __future__ import unicode_literals
+
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+_local_versions = {}
+_local_lock = threading.Lock()
+# Versions to bump again once the current thread's transactions are committed
+_pending = threading.local()
+
+
+def get_cache():
+    """Return the shared cache, or None if it hasn't been configured."""
+    alias = getattr(settings, 'MULTITENANCY_CACHE', None)
+    if alias is None:
+        return None
+    return caches[alias]
+
+
+def make_key(*parts):
+    """Build a cache key which is safe for all backends from arbitrary parts."""
+    digest = hashlib.md5(':'.join('{}'.format(p) for p in parts).encode('utf-8'))
+    return 'multitenancy:{}'.format(digest.hexdigest())
+
+
+def _initial_version():
+    # If the version key is evicted we don't want to start counting from
+    # the same number again and pick up entries stored under the old version.
+    return int(time.time() * 1000)
+
+
+def local_data_expired(loaded_at):
+    """
+    Return True if data cached in this process at loaded_at (a time.time() value)
+    must be reloaded.
+
+    Without MULTITENANCY_CACHE, versions are only bumped by signals sent in the
+    same process, so changes made by other processes would never be seen. Data is
+    then only kept for MULTITENANCY_LOCAL_CACHE_TIMEOUT seconds.
+    """
+    if get_cache() is not None:
+        return False
+    timeout = getattr(settings, 'MULTITENANCY_LOCAL_CACHE_TIMEOUT', 60)
+    return timeout is not None and time.time() - loaded_at > timeout
+
+
+def get_version(name):
+    """Return the current version of the named set of cached data."""
+    flush_pending_bumps(committed_only=True)
+    cache = get_cache()
+    if cache is None:
+        return _local_versions.get(name, 0)
+    key = 'multitenancy:version:{}'.format(name)
+    version = cache.get(key)
+    if version is None:
+        version = _initial_version()
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+def bump_version(name):
+    """Invalidate everything cached under the current version of name."""
+    with _local_lock:
+        _local_versions[name] = _local_versions.get(name, 0) + 1
+    cache = get_cache()
+    if cache is not None:
+        key = 'multitenancy:version:{}'.format(name)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Key is missing, so nothing can be cached under it
+            cache.add(key, _initial_version(), None)
+
+
+def bump_version_after_commit(name, using=None):
+    """
+    Bump the version of name again once the current transaction is committed.
+
+    Changes are invalidated by signals sent before the transaction commits, so
+    another process may read the old data in the meantime and cache it under the
+    new version. Django 1.7/1.8 have no on_commit hook, so the second bump is
+    done at the end of the request (see multitenancy.signals) or by the next
+    version lookup in this thread outside of the transaction, whichever is first.
+    """
+    using = using or DEFAULT_DB_ALIAS
+    if not connections[using].in_atomic_block:
+        return
+    pending = getattr(_pending, 'names', None)
+    if pending is None:
+        pending = _pending.names = set()
+    pending.add((using, name))
+
+
+def flush_pending_bumps(committed_only=False):
+    """Do the bumps scheduled by bump_version_after_commit()."""
+    pending = getattr(_pending, 'names', None)
+    if not pending:
+        return
+    for using, name in list(pending):
+        if committed_only and connections[using].in_atomic_block:
+            continue
+        pending.discard((using, name))
+        bump_version(name)
@@ -1,8 +1,112 @@
+from collections import defaultdict
+
 from django import forms
+from django.core.urlresolvers import NoReverseMatch, reverse
+from django.utils.encoding import force_text
+from django.utils.functional import cached_property
 
 from .models import Tenant, BackendLink
 
 
+def get_backend_link_queryset(tenant=None):
+    """BackendLinks which may be chosen for the tenant."""
+    # only show backends that are already associated with this tenant ...
+    if tenant is not None and tenant.pk:
+        qs = BackendLink.objects.by_tenant(tenant=tenant)
+    else:
+        qs = BackendLink.all_tenants.none()
+    # ... or are not associated with any Tenant
+    qs = qs | BackendLink.all_tenants.filter(tenant__isnull=True)
+    # ... and finally exclude MessageTester backends
+    return qs.exclude(is_message_tester=True)
+
+
+def get_backend_link_lookup_url(tenant=None):
+    """URL of the admin's BackendLink search for the tenant, or None if the admin isn't installed."""
+    try:
+        url = reverse('admin:multitenancy_tenant_backend_links')
+    except NoReverseMatch:
+        return None
+    if tenant is not None and tenant.pk:
+        url = '{}?tenant={}'.format(url, tenant.pk)
+    return url
+
+
+class BackendLinkLookupWidget(forms.Select):
+    """
+    Select which only renders the selected BackendLink. The other choices are
+    searched and paged through on demand by backend-link-lookup.js, so the size of
+    the rendered form doesn't depend on the number of backends.
+    """
+
+    def __init__(self, lookup_url, empty_label='---------', attrs=None):
+        final_attrs = {'class': 'backend-link-lookup', 'data-lookup-url': lookup_url}
+        final_attrs.update(attrs or {})
+        super(BackendLinkLookupWidget, self).__init__(attrs=final_attrs)
+        self.empty_label = empty_label
+        # links already loaded by the form, by pk, so that rendering them needs no query
+        self.known_links = {}
+
+    class Media:
+        js = ('multitenancy/js/backend-link-lookup.js', )
+
+    def render(self, name, value, attrs=None, choices=()):
+        # Replace the field's choices, which would list every available link
+        self.choices = []
+        if self.empty_label is not None:
+            self.choices.append(('', self.empty_label))
+        link = self.get_link(value)
+        if link is not None:
+            self.choices.append((link.pk, force_text(link)))
+        return super(BackendLinkLookupWidget, self).render(name, value, attrs)
+
+    def get_link(self, value):
+        if value in (None, ''):
+            return None
+        try:
+            pk = int(value)
+        except (TypeError, ValueError):
+            return None
+        if pk not in self.known_links:
+            self.known_links[pk] = BackendLink.all_tenants.select_related('backend').filter(pk=pk).first()
+        return self.known_links[pk]
+
+
+class BackendLinkChoices(object):
+    """
+    Backend link choices for a set of tenants, shared by the forms of a TenantFormSet
+    so that each of them doesn't query for the same links. The tenants' links are
+    loaded with a single query; the unassigned links are only loaded if the choices
+    have to be rendered in full (see TenantForm).
+    """
+
+    def __init__(self, tenants):
+        self.tenant_ids = [tenant.pk for tenant in tenants if tenant.pk]
+
+    @cached_property
+    def by_tenant(self):
+        by_tenant = defaultdict(list)
+        links = BackendLink.all_tenants.select_related('backend').filter(tenant__in=self.tenant_ids)
+        for link in links.order_by('pk'):
+            by_tenant[link.tenant_id].append(link)
+        return by_tenant
+
+    @cached_property
+    def unassigned(self):
+        links = BackendLink.all_tenants.select_related('backend').filter(tenant__isnull=True)
+        return list(links.exclude(is_message_tester=True).order_by('pk'))
+
+    def get_choices(self, tenant):
+        """Links which may be chosen for this tenant, excluding MessageTester backends."""
+        own = [link for link in self.by_tenant.get(tenant.pk, ()) if not link.is_message_tester]
+        return sorted(own + self.unassigned, key=lambda link: link.pk)
+
+    def get_initial(self, tenant):
+        """The tenant's first link, as given by tenant.backendlink_set.first()."""
+        links = self.by_tenant.get(tenant.pk)
+        return links[0] if links else None
+
+
 class TenantForm(forms.ModelForm):
     backend_link = forms.ModelChoiceField(queryset=BackendLink.all_tenants.none(),
                                           required=False)
@@ -12,25 +116,64 @@ class TenantForm(forms.ModelForm):
         fields = ('name', 'slug', 'description', 'group', 'backend_link')
 
     def __init__(self, *args, **kwargs):
+        # optional BackendLinkChoices shared with the other forms of a formset
+        backend_link_choices = kwargs.pop('backend_link_choices', None)
         super(TenantForm, self).__init__(*args, **kwargs)
-        # only show backends that are already associated with this tenant ...
-        if self.instance.pk:
-            qs = BackendLink.objects.by_tenant(tenant=self.instance)
+        field = self.fields['backend_link']
+        # The queryset is used to validate the submitted value in every case
+        field.queryset = get_backend_link_queryset(self.instance)
+        if backend_link_choices is None:
+            field.initial = self.instance.backendlink_set.select_related('backend').first()
         else:
-            qs = BackendLink.all_tenants.none()
-        # ... or are not associated with any Tenant
-        qs = qs | BackendLink.all_tenants.filter(tenant__isnull=True)
-        # ... and finally exclude MessageTester backends (they all start with 'mt_')
-        self.fields['backend_link'].queryset = qs.exclude(backend__name__startswith='mt_')
-        self.fields['backend_link'].initial = self.instance.backendlink_set.first()
+            field.initial = backend_link_choices.get_initial(self.instance)
+        lookup_url = get_backend_link_lookup_url(self.instance)
+        if lookup_url is not None:
+            # only render the selected link; the others are looked up on demand
+            field.widget = BackendLinkLookupWidget(lookup_url, empty_label=field.empty_label)
+            if field.initial is not None:
+                field.widget.known_links[field.initial.pk] = field.initial
+        elif backend_link_choices is not None:
+            # render the choices from the links loaded by the formset
+            choices = [(link.pk, field.label_from_instance(link))
+                       for link in backend_link_choices.get_choices(self.instance)]
+            if field.empty_label is not None:
+                choices.insert(0, ('', field.empty_label))
+            field.choices = choices
 
     def save(self, commit=True):
-        tenant = super(TenantForm, self).save(commit=commit)
         # we can't update backendlinks until tenant and tenantgroup
         # have been saved, so add them to the tenant object and save
-        # them in the model save method
-        if self.cleaned_data['backend_link']:
-            tenant.unsaved_backendlinks = [self.cleaned_data['backend_link'], ]
-        if commit:
-            tenant.save()
-        return tenant
+        # them in the model save method, in the same transaction
+        backend_link = self.cleaned_data['backend_link']
+        self.instance.unsaved_backendlinks = [backend_link] if backend_link else []
+        return super(TenantForm, self).save(commit=commit)
+
+
+class TenantFormSet(forms.BaseInlineFormSet):
+    """Inline formset of TenantForms which loads the backend link choices once."""
+
+    @property
+    def backend_link_choices(self):
+        if not hasattr(self, '_backend_link_choices'):
+            self._backend_link_choices = BackendLinkChoices(self.get_queryset())
+        return self._backend_link_choices
+
+    def _construct_form(self, i, **kwargs):
+        kwargs['backend_link_choices'] = self.backend_link_choices
+        form = super(TenantFormSet, self)._construct_form(i, **kwargs)
+        if self.instance.pk is not None:
+            # The inline displays each tenant with its group's name, so share the
+            # parent group rather than loading it again for every tenant
+            setattr(form.instance, self.fk.name, self.instance)
+        return form
+
+    @property
+    def empty_form(self):
+        form = self.form(
+            auto_id=self.auto_id,
+            prefix=self.add_prefix('__prefix__'),
+            empty_permitted=True,
+            backend_link_choices=self.backend_link_choices,
+        )
+        self.add_fields(form, None)
+        return form
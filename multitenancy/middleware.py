@@ -1,6 +1,6 @@
-from django.shortcuts import get_object_or_404
+from django.http import Http404
 
-from .models import Tenant, TenantGroup
+from .registry import registry
 
 
 class MultitenancyMiddleware(object):
@@ -17,6 +17,9 @@ class MultitenancyMiddleware(object):
     easier to create urls.
 
     Returns a 404 if the group or tenant does not exist.
+
+    Slug lookups are served from the process-local TenantRegistry, so resolving
+    a known (or known to be missing) tenant does not touch the database.
     """
 
     def process_view(self, request, view_func, view_args, view_kwargs):
@@ -24,17 +27,17 @@ class MultitenancyMiddleware(object):
         if 'tenant_slug' in view_kwargs:
             group_slug = view_kwargs.get('group_slug', '')
             tenant_slug = view_kwargs['tenant_slug']
-            tenant = get_object_or_404(
-                Tenant,
-                slug__iexact=tenant_slug,
-                group__slug__iexact=group_slug
-            )
+            tenant = registry.get_tenant(group_slug, tenant_slug)
+            if tenant is None:
+                raise Http404('No Tenant matches the given query.')
             request.tenants = [tenant]
             request.tenant_slug = tenant.slug
             request.group_slug = tenant.group.slug
         elif 'group_slug' in view_kwargs:
             # Only group, no tenant -> set tenants to a queryset of this group's tenants
             group_slug = view_kwargs['group_slug']
-            group = get_object_or_404(TenantGroup, slug__iexact=group_slug)
+            group = registry.get_group(group_slug)
+            if group is None:
+                raise Http404('No TenantGroup matches the given query.')
             request.tenants = group.tenants.all()
             request.group_slug = group.slug
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def backfill_normalized_slugs(apps, schema_editor):
+    for model_name in ('TenantGroup', 'Tenant'):
+        model = apps.get_model('multitenancy', model_name)
+        for pk, slug in model.objects.values_list('pk', 'slug'):
+            model.objects.filter(pk=pk).update(normalized_slug=slug.lower())
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('multitenancy', '0003_auto_20141115_1029'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tenant',
+            name='normalized_slug',
+            field=models.SlugField(default='', max_length=64, editable=False),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='tenantgroup',
+            name='normalized_slug',
+            field=models.SlugField(default='', max_length=64, editable=False),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_normalized_slugs, noop),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def backfill_is_message_tester(apps, schema_editor):
+    BackendLink = apps.get_model('multitenancy', 'BackendLink')
+    BackendLink.objects.filter(backend__name__startswith='mt_').update(is_message_tester=True)
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('multitenancy', '0004_normalized_slugs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backendlink',
+            name='is_message_tester',
+            field=models.BooleanField(default=False, db_index=True, editable=False),
+            preserve_default=True,
+        ),
+        migrations.RunPython(backfill_is_message_tester, noop),
+    ]
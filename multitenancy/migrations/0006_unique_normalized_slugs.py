@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+# Slugs are looked up ignoring case, so existing groups (or tenants in the same
+# group) whose slugs only differ by case have to be renamed before migrating.
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('multitenancy', '0005_backendlink_is_message_tester'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='tenantgroup',
+            name='normalized_slug',
+            field=models.SlugField(unique=True, max_length=64, editable=False),
+            preserve_default=True,
+        ),
+        migrations.AlterUniqueTogether(
+            name='tenant',
+            unique_together=set([('group', 'slug'), ('group', 'normalized_slug'), ('group', 'name')]),
+        ),
+    ]
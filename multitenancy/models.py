@@ -1,74 +1,186 @@
 from __future__ import unicode_literals
 
+from itertools import islice
+
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import models, router, transaction
 from django.utils.functional import cached_property
 from django.utils.translation import ugettext_lazy as _
 
 from rapidsms.models import Backend, Contact
 
+from .cache import bump_version_after_commit
+
+
+# Names of the backends used by the message tester all start with this
+MESSAGE_TESTER_PREFIX = 'mt_'
+
+
+def normalize_slug(slug):
+    """Return the form of a slug which is stored for case-insensitive lookups."""
+    return slug.lower()
+
+
+def _validate_normalized_slug(instance, exclude, **filters):
+    # The unique constraints on normalized_slug aren't checked by model forms,
+    # since the field isn't editable, so report slugs only differing by case
+    if exclude and 'slug' in exclude or not instance.slug:
+        return
+    others = type(instance)._default_manager.filter(
+        normalized_slug=normalize_slug(instance.slug), **filters)
+    if instance.pk is not None:
+        others = others.exclude(pk=instance.pk)
+    if others.exists():
+        raise ValidationError({'slug': [_('This slug is already used, ignoring case.')]})
+
+
+def _normalize_update_fields(update_fields):
+    # Keep normalized_slug in sync when only some fields are being saved
+    if update_fields is not None and 'slug' in update_fields:
+        update_fields = set(update_fields) | {'normalized_slug'}
+    return update_fields
+
 
 class TenantGroup(models.Model):
     name = models.CharField(max_length=64, unique=True)
     slug = models.SlugField(max_length=64, unique=True)
+    # Lowercased copy of slug, so case-insensitive lookups can use an index
+    normalized_slug = models.SlugField(max_length=64, unique=True, editable=False)
     description = models.TextField(blank=True)
 
     def __unicode__(self):
         return self.name
 
+    def validate_unique(self, exclude=None):
+        super(TenantGroup, self).validate_unique(exclude)
+        _validate_normalized_slug(self, exclude)
+
+    def save(self, *args, **kwargs):
+        self.normalized_slug = normalize_slug(self.slug)
+        if 'update_fields' in kwargs:
+            kwargs['update_fields'] = _normalize_update_fields(kwargs['update_fields'])
+        super(TenantGroup, self).save(*args, **kwargs)
+
     def get_absolute_url(self):
         return reverse('group-detail', kwargs=dict(group_slug=self.slug))
 
 
+class TenantModelQuerySet(models.query.QuerySet):
+    """QuerySet for the Tenant model itself (see TenantQuerySet for TenantEnabled models)."""
+
+    def with_backends(self):
+        """Load the backends of all of the tenants with one additional query."""
+        links = BackendLink.all_tenants.select_related('backend').order_by('backend__pk')
+        return self.prefetch_related(
+            models.Prefetch('backendlink_set', queryset=links, to_attr='_prefetched_backendlinks'))
+
+
 class Tenant(models.Model):
     name = models.CharField(max_length=64)
     slug = models.SlugField(max_length=64)
+    # Lowercased copy of slug, so case-insensitive lookups can use an index
+    normalized_slug = models.SlugField(max_length=64, editable=False)
     description = models.TextField(blank=True)
     group = models.ForeignKey(TenantGroup, related_name='tenants')
 
+    objects = TenantModelQuerySet.as_manager()
+
     class Meta:
         unique_together = (('group', 'slug'),
+                           ('group', 'normalized_slug'),
                            ('group', 'name'))
 
     def __unicode__(self):
         return '{} ({})'.format(self.name, self.group.name)
 
+    def validate_unique(self, exclude=None):
+        super(Tenant, self).validate_unique(exclude)
+        if self.group_id is not None:
+            _validate_normalized_slug(self, exclude, group_id=self.group_id)
+
     def get_absolute_url(self):
         return reverse('tenant-detail', kwargs=dict(group_slug=self.group.slug,
                                                     tenant_slug=self.slug))
 
     def add_backend(self, backend):
         "Add a RapidSMS backend to this tenant"
-        if backend in self.get_backends():
+        if hasattr(self, '_prefetched_backendlinks'):
+            linked = any(link.backend_id == backend.pk for link in self._prefetched_backendlinks)
+        else:
+            linked = self.backendlink_set.filter(backend=backend).exists()
+        if linked:
             return
         backend_link, created = BackendLink.all_tenants.get_or_create(backend=backend)
         self.backendlink_set.add(backend_link)
+        self._backends_changed(self._state.db)
 
     def get_backend_names(self):
         return u'\n'.join(b.name for b in self.get_backends())
     get_backend_names.short_description = _('Backends')
 
     def get_backends(self):
-        return Backend.objects.filter(tenantlink__in=self.backendlink_set.all())
+        """
+        Return a QuerySet of this tenant's backends. If they were loaded with
+        Tenant.objects.with_backends(), the QuerySet is already evaluated.
+        """
+        backends = Backend.objects.filter(tenantlink__tenant=self)
+        if hasattr(self, '_prefetched_backendlinks'):
+            # The same way Django fills in the cache of prefetched related managers
+            backends._result_cache = [link.backend for link in self._prefetched_backendlinks]
+            backends._prefetch_done = True
+        return backends
 
     @cached_property
     def primary_backend(self):
         """
         Each tenant has one external backend. This method returns that backend, by excluding
-        backends associated with the message_tester.
+        backends associated with the message_tester. It is looked up in the process-wide
+        routing table, so it usually doesn't need a query.
+        """
+        from .routing import routing_table
+        return routing_table.get_primary_backend(self.pk)
+
+    def _backends_changed(self, using=None):
+        # Bulk updates of backend links (including the related manager's clear())
+        # don't send any signals, so let the caches know explicitly, now and
+        # again once the transaction is committed (see multitenancy.signals)
+        self.__dict__.pop('_prefetched_backendlinks', None)
+        from .routing import identity_resolver, routing_table
+        for cached in (routing_table, identity_resolver):
+            cached.invalidate()
+            bump_version_after_commit(cached.version_name, using)
+
+    def _reconcile_backendlinks(self, using):
         """
-        return self.get_backends().exclude(name__startswith='mt_').first()
+        Link exactly the backends in unsaved_backendlinks to this tenant, plus any
+        MessageTester backends it already has, touching only the links which change.
+        """
+        wanted = set(link.pk for link in getattr(self, 'unsaved_backendlinks', ()))
+        links = BackendLink.all_tenants.using(using)
+        current = dict(links.filter(tenant=self).values_list('pk', 'is_message_tester'))
+        remove = [pk for pk, tester in current.items() if pk not in wanted and not tester]
+        add = [pk for pk in wanted if pk not in current]
+        if remove:
+            links.filter(pk__in=remove).update(tenant=None)
+        if add:
+            links.filter(pk__in=add).update(tenant=self)
+        for link in getattr(self, 'unsaved_backendlinks', ()):
+            link.tenant = self
+        if remove or add:
+            self._backends_changed(using)
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
-        self.backendlink_set.clear()
-        # post_save signal gets called during the next statement (which is why
-        # we clear backendlinks above. If we were to clear it later, then it
-        # would overwrite our post_save signal in messagetester)
-        super(Tenant, self).save(force_insert, force_update, using, update_fields)
-        if hasattr(self, 'unsaved_backendlinks'):
-            self.backendlink_set.add(*self.unsaved_backendlinks)
+        self.normalized_slug = normalize_slug(self.slug)
+        update_fields = _normalize_update_fields(update_fields)
+        using = using or router.db_for_write(self.__class__, instance=self)
+        with transaction.atomic(using=using):
+            # post_save signal gets called during the next statement, and the
+            # messagetester uses it to link its backend to the tenant. Those
+            # links are kept when reconciling the other links afterwards.
+            super(Tenant, self).save(force_insert, force_update, using, update_fields)
+            self._reconcile_backendlinks(using)
 
 
 class TenantRole(models.Model):
@@ -103,49 +215,132 @@ class MultitenantIncompatiblityError(Exception):
     pass
 
 
+def get_tenant_id(tenant):
+    """Return the id of a Tenant given either the Tenant or its primary key."""
+    return getattr(tenant, 'pk', tenant)
+
+
 class TenantQuerySet(models.query.QuerySet):
-    """QuerySet extension to provide filtering by Tenant"""
+    """
+    QuerySet extension to provide filtering by Tenant.
 
-    tenant = None
+    A queryset is scoped to a single tenant (by_tenant), to a set of tenants
+    (by_tenants) or to all of the tenants of a group (by_group). Objects can only
+    be created through a queryset scoped to exactly one tenant.
+    """
 
-    def __init__(self, model=None, query=None, using=None, hints=None, tenant=None):
+    tenant_id = None
+    tenant_ids = None
+    group_id = None
+    _tenant = None
+
+    def __init__(self, model=None, query=None, using=None, hints=None,
+                 tenant=None, tenants=None, group=None):
         super(TenantQuerySet, self).__init__(model, query, using, hints)
-        self.tenant = tenant
+        # Only ids are kept, so that callers which only have the ids don't need
+        # to load the Tenants
+        self.tenant_id = get_tenant_id(tenant)
+        if isinstance(tenant, Tenant):
+            self._tenant = tenant
+        if tenants is not None:
+            self.tenant_ids = frozenset(get_tenant_id(t) for t in tenants)
+            if self.tenant_id is None and len(self.tenant_ids) == 1:
+                # exactly one tenant, so objects can be created for it
+                self.tenant_id, = self.tenant_ids
+        self.group_id = getattr(group, 'pk', group)
 
     def _clone(self, klass=None, setup=False, **kwargs):
-        kwargs['tenant'] = self.tenant
+        kwargs['tenant_id'] = self.tenant_id
+        kwargs['tenant_ids'] = self.tenant_ids
+        kwargs['group_id'] = self.group_id
+        kwargs['_tenant'] = self._tenant
         return super(TenantQuerySet, self)._clone(klass, setup, **kwargs)
 
+    @property
+    def tenant(self):
+        """
+        The Tenant the queryset is scoped to, or None.
+
+        Deprecated: use tenant_id. Kept for backwards compatibility, the Tenant is
+        loaded on first access unless it was passed to by_tenant().
+        """
+        if self._tenant is None and self.tenant_id is not None:
+            self._tenant = Tenant.objects.get(pk=self.tenant_id)
+        return self._tenant
+
+    def is_scoped(self):
+        """Whether the queryset was created by one of the TenantManager's by_* methods."""
+        return self.tenant_id is not None or self.tenant_ids is not None or self.group_id is not None
+
     # Helper method to add our Tenant to queries
     def add_tenant_to_kwargs(self, **kwargs):
-        if kwargs.get('tenant', self.tenant) != self.tenant:
+        self.check_single_tenant()
+        for name in ('tenant', 'tenant_id'):
+            if name in kwargs and get_tenant_id(kwargs[name]) != self.tenant_id:
+                raise MultitenantIncompatiblityError(
+                    "Tenant provided in by_tenant (%(tenant1)s) doesn't match Tenant "
+                    "provided in kwargs (%(tenant2)s)"
+                    % {'tenant1': self.tenant_id, 'tenant2': get_tenant_id(kwargs[name])}
+                )
+        kwargs.pop('tenant', None)
+        kwargs['tenant_id'] = self.tenant_id
+        return kwargs
+
+    def check_single_tenant(self):
+        if self.tenant_id is None:
             raise MultitenantIncompatiblityError(
-                "Tenant provided in by_tenant (%(tenant1)s) doesn't match Tenant "
-                "provided in kwargs (%(tenant2)s)"
-                % {'tenant1': self.tenant, 'tenant2': kwargs['tenant']}
+                "Objects can only be created for a single tenant. Use by_tenant(tenant) "
+                "rather than by_tenants(tenants) or by_group(group)."
             )
-        else:
-            kwargs['tenant'] = self.tenant
-        return kwargs
 
     # Filter everything by Tenant
     def by_tenant(self):
         kwargs = self.add_tenant_to_kwargs()
         return self.filter(**kwargs)
 
+    def by_tenants(self):
+        return self.filter(tenant_id__in=sorted(self.tenant_ids))
+
+    def by_group(self):
+        return self.filter(tenant__group_id=self.group_id)
+
     # Override queries that write to add our Tenant
     def bulk_create(self, objs, batch_size=None):
+        self.check_single_tenant()
         for obj in objs:
-            if getattr(obj, 'tenant', None) and obj.tenant != self.tenant:
+            # compare ids, so that the objects' tenants aren't loaded
+            if obj.tenant_id is not None and obj.tenant_id != self.tenant_id:
                 raise MultitenantIncompatiblityError(
                     "Tenant provided in by_tenant (%(tenant1)s) doesn't match Tenant "
                     "provided in object (%(tenant2)s)"
-                    % {'tenant1': self.tenant, 'tenant2': obj.tenant}
+                    % {'tenant1': self.tenant_id, 'tenant2': obj.tenant_id}
                 )
 
-            obj.tenant = self.tenant
+            obj.tenant_id = self.tenant_id
         return super(TenantQuerySet, self).bulk_create(objs, batch_size)
 
+    def bulk_create_iter(self, objs, batch_size=1000):
+        """
+        Like bulk_create(), but objs can be any iterable, such as a generator. It is
+        consumed batch_size objects at a time, so only one batch is held in memory,
+        and all batches are inserted in a single transaction. Returns the number of
+        objects created.
+        """
+        self.check_single_tenant()
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1.")
+        objs = iter(objs)
+        count = 0
+        with transaction.atomic(using=self._db or router.db_for_write(self.model)):
+            while True:
+                batch = list(islice(objs, batch_size))
+                if not batch:
+                    break
+                # checks and sets the tenant of the batch's objects
+                self.bulk_create(batch, batch_size)
+                count += len(batch)
+        return count
+
     def create(self, **kwargs):
         kwargs = self.add_tenant_to_kwargs(**kwargs)
         return super(TenantQuerySet, self).create(**kwargs)
@@ -157,20 +352,32 @@ class TenantQuerySet(models.query.QuerySet):
 
 class TenantManager(models.Manager):
 
-    def get_queryset(self, tenant=None):
-        qs = TenantQuerySet(self.model, tenant=tenant)
-        if not qs.tenant:
+    def get_queryset(self, tenant=None, tenants=None, group=None):
+        qs = TenantQuerySet(self.model, tenant=tenant, tenants=tenants, group=group)
+        if not qs.is_scoped():
             raise MultitenantIncompatiblityError(
-                "All queries on a TenantEnabled model must use .by_tenant(tenant) "
-                "as the first query in your chain. Use the all_tenants Manager if "
-                "you really want objects from multiple tenants."
+                "All queries on a TenantEnabled model must use .by_tenant(tenant), "
+                ".by_tenants(tenants) or .by_group(group) as the first query in your "
+                "chain. Use the all_tenants Manager if you really want objects from "
+                "all tenants."
             )
         return qs
 
     def by_tenant(self, tenant):
+        """Objects of the tenant, which can be given as a Tenant or its primary key."""
         qs = self.get_queryset(tenant=tenant)
         return qs.by_tenant()
 
+    def by_tenants(self, tenants):
+        """Objects of any of the tenants (Tenants or primary keys), in a single query."""
+        qs = self.get_queryset(tenants=tenants)
+        return qs.by_tenants()
+
+    def by_group(self, group):
+        """Objects of all of the tenants of the group (a TenantGroup or its primary key)."""
+        qs = self.get_queryset(group=group)
+        return qs.by_group()
+
 
 class TenantEnabled(models.Model):
     tenant = models.ForeignKey(Tenant, null=True, default=None, on_delete=models.SET_NULL)
@@ -183,12 +390,23 @@ class TenantEnabled(models.Model):
         abstract = True
 
 
+def is_message_tester_backend(name):
+    """MessageTester backends are identified by their name."""
+    return name.startswith(MESSAGE_TESTER_PREFIX)
+
+
 class BackendLink(TenantEnabled):
     backend = models.OneToOneField(Backend, related_name='tenantlink')
+    # Denormalized from the backend name, so that filtering doesn't need a LIKE on the joined table
+    is_message_tester = models.BooleanField(default=False, db_index=True, editable=False)
 
     def __unicode__(self):
         return self.backend.name
 
+    def save(self, *args, **kwargs):
+        self.is_message_tester = is_message_tester_backend(self.backend.name)
+        super(BackendLink, self).save(*args, **kwargs)
+
 
 class ContactLink(TenantEnabled):
     description = models.CharField(max_length=200, blank=True)
@@ -0,0 +1,118 @@
+from __future__ import unicode_literals
+
+import threading
+import time
+
+from .cache import bump_version, get_cache, get_version, local_data_expired, make_key
+from .models import Tenant, TenantGroup, normalize_slug
+from .utils import build_instance, instance_values
+
+
+class TenantRegistry(object):
+    """
+    Cache of Tenant and TenantGroup slug lookups and of tenant to group mappings.
+
+    Lookups are keyed on the normalized (lowercased) slugs, so they keep the
+    case-insensitive behavior of the middleware while matching on an index.
+    Misses are cached too, so that repeated requests for unknown slugs don't go
+    to the database.
+
+    Entries are kept in the current process and, if ``MULTITENANCY_CACHE`` is set,
+    in the shared cache as well. All entries are stored under a generation number
+    which is bumped whenever a Tenant or TenantGroup is saved or deleted (see
+    multitenancy.signals), so every process drops its stale entries at once.
+    Without the shared cache, other processes' changes aren't signalled, so the
+    entries are dropped after MULTITENANCY_LOCAL_CACHE_TIMEOUT seconds instead.
+
+    The registry never hands out the instances it stores; each call returns
+    fresh model instances so that callers are free to modify them.
+    """
+
+    version_name = 'registry'
+    # Culling threshold, to keep the cache of misses from growing without bound
+    max_entries = 10000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generation = None
+        self._loaded_at = 0
+        self._entries = {}
+
+    def invalidate(self):
+        """Forget everything. Called whenever a Tenant or TenantGroup changes."""
+        bump_version(self.version_name)
+        with self._lock:
+            self._generation = None
+            self._entries = {}
+
+    def get_tenant(self, group_slug, tenant_slug):
+        """Return the matching Tenant (with its group loaded) or None."""
+        entry = self._get(self._load_tenant, 'tenant',
+                          normalize_slug(group_slug), normalize_slug(tenant_slug))
+        if entry is None:
+            return None
+        tenant_values, group_values = entry
+        tenant = build_instance(Tenant, tenant_values)
+        tenant.group = build_instance(TenantGroup, group_values)
+        return tenant
+
+    def get_group(self, group_slug):
+        """Return the matching TenantGroup or None."""
+        entry = self._get(self._load_group, 'group', normalize_slug(group_slug))
+        if entry is None:
+            return None
+        return build_instance(TenantGroup, entry)
+
+    def get_tenant_group_id(self, tenant_id):
+        """Return the id of the group the given tenant belongs to, or None."""
+        return self._get(self._load_tenant_group_id, 'tenant-group', tenant_id)
+
+    def _get(self, loader, *key):
+        generation = get_version(self.version_name)
+        with self._lock:
+            if generation != self._generation or local_data_expired(self._loaded_at):
+                self._generation = generation
+                self._loaded_at = time.time()
+                self._entries = {}
+            try:
+                return self._entries[key]
+            except KeyError:
+                pass
+        cache = get_cache()
+        cache_key = make_key(self.version_name, generation, *key)
+        cached = cache.get(cache_key) if cache is not None else None
+        if cached is not None:
+            # Values are wrapped in a tuple so that misses can be cached as well
+            entry = cached[0]
+        else:
+            entry = loader(*key[1:])
+            if cache is not None:
+                cache.set(cache_key, (entry, ))
+        with self._lock:
+            # Don't store results which may have been invalidated while loading
+            if generation == self._generation:
+                if len(self._entries) >= self.max_entries:
+                    self._entries = {}
+                self._entries[key] = entry
+        return entry
+
+    def _load_tenant(self, group_slug, tenant_slug):
+        tenant = Tenant.objects.select_related('group').filter(
+            normalized_slug=tenant_slug,
+            group__normalized_slug=group_slug
+        ).first()
+        if tenant is None:
+            return None
+        return instance_values(tenant), instance_values(tenant.group)
+
+    def _load_group(self, group_slug):
+        group = TenantGroup.objects.filter(normalized_slug=group_slug).first()
+        if group is None:
+            return None
+        return instance_values(group)
+
+    def _load_tenant_group_id(self, tenant_id):
+        return Tenant.objects.filter(pk=tenant_id).values_list('group_id', flat=True).first()
+
+
+registry = TenantRegistry()
@@ -0,0 +1,179 @@
+from __future__ import unicode_literals
+
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from rapidsms.models import Backend, Connection
+
+from .cache import bump_version, get_version, local_data_expired
+from .models import BackendLink, Tenant, TenantGroup
+from .utils import LRUCache, build_instance, instance_values
+
+
+class RoutingData(object):
+    """One snapshot of the routing table."""
+
+    def __init__(self):
+        # tenant id -> (is_message_tester, backend snapshot) pairs, ordered by backend id
+        self.backends = {}
+        # backend id / backend name -> tenant id
+        self.tenant_by_backend_id = {}
+        self.tenant_by_backend_name = {}
+        # tenant id -> (tenant snapshot, group snapshot)
+        self.tenants = {}
+
+
+class BackendRoutingTable(object):
+    """
+    Process-wide table of the RapidSMS backends linked to each tenant, and of the
+    tenant linked to each backend.
+
+    The whole table is built with a single query the first time it is needed and
+    rebuilt after a BackendLink, Backend or Tenant changes (see multitenancy.signals).
+    The version of the table is shared through MULTITENANCY_CACHE, if set, so
+    changes made by one process are seen by all of them. Without it, the table is
+    also rebuilt once it is MULTITENANCY_LOCAL_CACHE_TIMEOUT seconds old, so that
+    processes such as the RapidSMS router see changes made by the web processes.
+
+    As with the TenantRegistry, fresh model instances are returned on every call.
+    """
+
+    version_name = 'routing'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._data = None
+        self._built_at = 0
+
+    def invalidate(self):
+        """Rebuild the table the next time it's used."""
+        bump_version(self.version_name)
+        with self._lock:
+            self._version = self._data = None
+
+    def get_backends(self, tenant_id):
+        """Return a list of all of the backends of the tenant, ordered by id."""
+        return [build_instance(Backend, entry) for tester, entry in self._get_data().backends.get(tenant_id, ())]
+
+    def get_primary_backend(self, tenant_id):
+        """
+        Return the external backend of the tenant, i.e. its first backend which
+        isn't associated with the message tester, or None.
+        """
+        for tester, entry in self._get_data().backends.get(tenant_id, ()):
+            if not tester:
+                return build_instance(Backend, entry)
+        return None
+
+    def get_tenant_id(self, backend_id=None, backend_name=None):
+        """Return the id of the tenant linked to the backend with the given id or name, or None."""
+        data = self._get_data()
+        if backend_id is not None:
+            return data.tenant_by_backend_id.get(backend_id)
+        return data.tenant_by_backend_name.get(backend_name)
+
+    def get_tenant(self, tenant_id):
+        """Return the Tenant (with its group loaded) if it has any backends, else None."""
+        entry = self._get_data().tenants.get(tenant_id)
+        if entry is None:
+            return None
+        tenant_values, group_values = entry
+        tenant = build_instance(Tenant, tenant_values)
+        tenant.group = build_instance(TenantGroup, group_values)
+        return tenant
+
+    def _get_data(self):
+        version = get_version(self.version_name)
+        with self._lock:
+            if (self._data is not None and self._version == version and
+                    not local_data_expired(self._built_at)):
+                return self._data
+        built_at = time.time()
+        data = self._build()
+        with self._lock:
+            # The version was read before building, so a change made while
+            # building causes another rebuild on the next call.
+            self._version, self._data, self._built_at = version, data, built_at
+        return data
+
+    def _build(self):
+        data = RoutingData()
+        links = BackendLink.all_tenants.filter(tenant__isnull=False)
+        for link in links.select_related('backend', 'tenant__group').order_by('backend__pk'):
+            entry = (link.is_message_tester, instance_values(link.backend))
+            data.backends.setdefault(link.tenant_id, []).append(entry)
+            data.tenant_by_backend_id[link.backend_id] = link.tenant_id
+            data.tenant_by_backend_name[link.backend.name] = link.tenant_id
+            if link.tenant_id not in data.tenants:
+                data.tenants[link.tenant_id] = (instance_values(link.tenant), instance_values(link.tenant.group))
+        data.backends = dict((tenant_id, tuple(entries)) for tenant_id, entries in data.backends.items())
+        return data
+
+
+routing_table = BackendRoutingTable()
+
+
+ResolvedIdentity = namedtuple('ResolvedIdentity', ('tenant_id', 'contact_id', 'contact_link_id'))
+
+
+class IdentityResolver(object):
+    """
+    Resolves (backend, identity) pairs of incoming messages to their tenant, contact
+    and ContactLink ids.
+
+    Pairs which aren't in the per-process LRU cache are looked up together with a
+    single query. Only existing connections are cached, and the cache is dropped
+    whenever a connection changes contact, a ContactLink is created or deleted, or
+    a BackendLink changes (see multitenancy.signals).
+    """
+
+    version_name = 'identities'
+
+    def __init__(self):
+        self._cache = None
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = LRUCache(
+                max_size=getattr(settings, 'MULTITENANCY_IDENTITY_CACHE_SIZE', 10000),
+                timeout=getattr(settings, 'MULTITENANCY_IDENTITY_CACHE_TIMEOUT', 300),
+            )
+        return self._cache
+
+    def invalidate(self):
+        bump_version(self.version_name)
+
+    def reset(self):
+        """Drop the cache, so it is recreated with the current settings."""
+        self._cache = None
+
+    def resolve(self, pairs):
+        """
+        Return a list of ResolvedIdentity (or None, if there is no such connection)
+        for each (backend, identity) pair. The backend may be given by name or as a
+        Backend instance.
+        """
+        version = get_version(self.version_name)
+        keys = [(getattr(backend, 'name', backend), identity) for backend, identity in pairs]
+        results = dict((key, self.cache.get((version, ) + key)) for key in keys)
+        missing = [key for key, result in results.items() if result is None]
+        if missing:
+            connections = Connection.objects.filter(
+                backend__name__in=set(name for name, identity in missing),
+                identity__in=set(identity for name, identity in missing),
+            ).values_list('backend__name', 'identity', 'backend__tenantlink__tenant',
+                          'contact', 'contact__contactlink')
+            for name, identity, tenant_id, contact_id, contact_link_id in connections:
+                # The query may match other combinations of the names and identities
+                if (name, identity) in results:
+                    result = ResolvedIdentity(tenant_id, contact_id, contact_link_id)
+                    results[(name, identity)] = result
+                    self.cache.set((version, name, identity), result)
+        return [results[key] for key in keys]
+
+
+identity_resolver = IdentityResolver()
@@ -0,0 +1,126 @@
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+from rapidsms.models import Backend, Connection
+
+from .auth import reset_decision_cache, role_version_name
+from .cache import bump_version, bump_version_after_commit, flush_pending_bumps
+from .models import BackendLink, ContactLink, Tenant, TenantGroup, TenantRole, is_message_tester_backend
+from .registry import registry
+from .routing import identity_resolver, routing_table
+
+
+def invalidate(cached, using):
+    """
+    Invalidate cached data now and again once the transaction is committed, as
+    other processes may cache the old data under the new version meanwhile.
+    """
+    cached.invalidate()
+    bump_version_after_commit(cached.version_name, using)
+
+
+@receiver(request_finished)
+def request_done(sender, **kwargs):
+    """Any transaction of the request is over, so do the bumps left for after it."""
+    flush_pending_bumps()
+
+
+@receiver(post_save, sender=Tenant)
+@receiver(post_delete, sender=Tenant)
+@receiver(post_save, sender=TenantGroup)
+@receiver(post_delete, sender=TenantGroup)
+def clear_tenant_registry(sender, using=None, **kwargs):
+    """Slugs or group membership may have changed, so forget cached lookups."""
+    invalidate(registry, using)
+
+
+@receiver(post_save, sender=Tenant)
+@receiver(post_delete, sender=Tenant)
+@receiver(post_save, sender=TenantGroup)
+@receiver(post_save, sender=Backend)
+@receiver(post_delete, sender=Backend)
+@receiver(post_save, sender=BackendLink)
+@receiver(post_delete, sender=BackendLink)
+def clear_routing_table(sender, using=None, **kwargs):
+    """The backends linked to a tenant, or the tenant of a backend, may have changed."""
+    invalidate(routing_table, using)
+
+
+@receiver(post_save, sender=Backend)
+def backend_saved(sender, instance, created, raw=False, **kwargs):
+    """Keep BackendLink.is_message_tester in sync with renamed backends."""
+    if not created and not raw:
+        BackendLink.all_tenants.filter(backend=instance).exclude(
+            is_message_tester=is_message_tester_backend(instance.name)
+        ).update(is_message_tester=is_message_tester_backend(instance.name))
+
+
+@receiver(post_save, sender=Backend)
+@receiver(post_delete, sender=Backend)
+@receiver(post_save, sender=BackendLink)
+@receiver(post_delete, sender=BackendLink)
+@receiver(post_delete, sender=Connection)
+@receiver(post_delete, sender=Tenant)
+def clear_identities(sender, using=None, **kwargs):
+    """
+    The tenant or contact of existing connections may have changed, or their
+    backend, by which they are cached, may have been renamed. Deleting a tenant
+    unlinks its backends without sending any signals for the links.
+    """
+    invalidate(identity_resolver, using)
+
+
+@receiver(post_save, sender=Connection)
+def connection_changed(sender, created, using=None, **kwargs):
+    # New connections were never cached, so they don't invalidate anything
+    if not created:
+        invalidate(identity_resolver, using)
+
+
+@receiver(post_save, sender=ContactLink)
+@receiver(post_delete, sender=ContactLink)
+def contact_link_changed(sender, created=True, using=None, **kwargs):
+    """A contact gained or lost its ContactLink."""
+    if created:
+        invalidate(identity_resolver, using)
+
+
+@receiver(pre_save, sender=TenantRole)
+def role_reassigned(sender, instance, raw=False, using=None, **kwargs):
+    """A role moved to another user is a change for the previous user as well."""
+    if instance.pk and not raw:
+        previous = TenantRole.objects.filter(pk=instance.pk).values_list('user_id', flat=True).first()
+        if previous is not None and previous != instance.user_id:
+            bump_version(role_version_name(previous))
+            bump_version_after_commit(role_version_name(previous), using)
+
+
+@receiver(post_save, sender=TenantRole)
+@receiver(post_delete, sender=TenantRole)
+def role_changed(sender, instance, using=None, **kwargs):
+    """
+    Invalidate the cached roles of the affected user, again after the commit so
+    that roles read by other requests before it aren't kept.
+    """
+    bump_version(role_version_name(instance.user_id))
+    bump_version_after_commit(role_version_name(instance.user_id), using)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def user_changed(sender, instance, created=True, **kwargs):
+    """Make sure nothing cached for a previous user with the same id is reused."""
+    if created:
+        bump_version(role_version_name(instance.pk))
+
+
+@receiver(setting_changed)
+def permission_cache_setting_changed(sender, setting, **kwargs):
+    if setting.startswith('MULTITENANCY_PERMISSION_CACHE'):
+        reset_decision_cache()
+    elif setting.startswith('MULTITENANCY_IDENTITY_CACHE'):
+        identity_resolver.reset()
@@ -0,0 +1,68 @@
+/*
+ * Loads the choices of the selects rendered by BackendLinkLookupWidget, which
+ * only contain the selected backend link, from the URL in their
+ * data-lookup-url attribute. Choices are loaded the first time the select is
+ * used, can be searched with the input added after the select, and are paged
+ * through with the last "more" option.
+ */
+(function($) {
+    'use strict';
+
+    var SELECTOR = 'select.backend-link-lookup';
+
+    function load($select, page) {
+        $.getJSON($select.data('lookup-url'), {q: $select.data('lookup-term') || '', page: page}, function(data) {
+            var selected = $select.val();
+            if (page === 1) {
+                // keep the blank and the selected options
+                $select.find('option').filter(function() {
+                    return this.value && this.value !== selected;
+                }).remove();
+            }
+            $select.find('option.backend-link-lookup-more').remove();
+            $.each(data.results, function(i, result) {
+                if (String(result.id) !== selected) {
+                    $('<option>').val(result.id).text(result.text).appendTo($select);
+                }
+            });
+            if (data.more) {
+                $('<option class="backend-link-lookup-more">').val('').text('…')
+                    .data('page', page + 1).appendTo($select);
+            }
+        });
+    }
+
+    function init($select) {
+        var timeout;
+        $select.data('lookup-loaded', true).data('lookup-selected', $select.val());
+        $('<input type="search" class="backend-link-lookup-search">').insertAfter($select)
+            .on('input', function() {
+                var term = this.value;
+                clearTimeout(timeout);
+                timeout = setTimeout(function() {
+                    $select.data('lookup-term', term);
+                    load($select, 1);
+                }, 250);
+            });
+        load($select, 1);
+    }
+
+    $(document).on('focus mousedown', SELECTOR, function() {
+        var $select = $(this);
+        if (!$select.data('lookup-loaded')) {
+            init($select);
+        }
+    });
+
+    $(document).on('change', SELECTOR, function() {
+        var $select = $(this),
+            $more = $select.find('option.backend-link-lookup-more:selected');
+        if ($more.length) {
+            // restore the previous selection and fetch the next page instead
+            $select.val($select.data('lookup-selected'));
+            load($select, $more.data('page'));
+        } else {
+            $select.data('lookup-selected', $select.val());
+        }
+    });
+})((window.django && window.django.jQuery) || window.jQuery);
@@ -0,0 +1,130 @@
+from __future__ import unicode_literals
+
+import hashlib
+import logging
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError, router, transaction
+
+from rapidsms.models import Backend
+
+from .cache import get_cache, make_key
+from .models import BackendLink, is_message_tester_backend
+from .routing import routing_table
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds a process may hold the lock while syncing at startup
+SYNC_LOCK_TIMEOUT = 60
+
+
+def sync_backend_links(names, dry_run=False, using=None):
+    """
+    Make sure there is a Backend and a BackendLink for each of the backend names.
+
+    The existing Backends and BackendLinks are found with one query each, and the
+    missing ones are created in bulk in a single transaction. Returns the names of
+    the backends which got a new BackendLink (or would have, with dry_run), in the
+    order they were given.
+    """
+    names = list(OrderedDict.fromkeys(names))
+    if not names:
+        return []
+    using = using or router.db_for_write(BackendLink)
+    backend_ids = dict(
+        Backend.objects.using(using).filter(name__in=names).values_list('name', 'pk')
+    )
+    linked = set(
+        BackendLink.all_tenants.using(using).filter(
+            backend__name__in=names).values_list('backend__name', flat=True)
+    )
+    missing = [name for name in names if name not in linked]
+    if dry_run or not missing:
+        return missing
+    with transaction.atomic(using=using):
+        new_names = [name for name in missing if name not in backend_ids]
+        if new_names:
+            Backend.objects.using(using).bulk_create([Backend(name=name) for name in new_names])
+            # bulk_create doesn't set the primary keys, so fetch them
+            backend_ids.update(
+                Backend.objects.using(using).filter(name__in=new_names).values_list('name', 'pk')
+            )
+        # bulk_create bypasses BackendLink.save(), so set the flag it would have set
+        BackendLink.all_tenants.using(using).bulk_create([
+            BackendLink(backend_id=backend_ids[name], is_message_tester=is_message_tester_backend(name))
+            for name in missing
+        ])
+    # nor are any signals sent for the new rows
+    routing_table.invalidate()
+    return missing
+
+
+def get_fingerprint(names):
+    """Hash of a set of backend names, which doesn't depend on their order."""
+    return hashlib.sha1('\n'.join(sorted(set(names))).encode('utf-8')).hexdigest()
+
+
+def get_shared_cache():
+    """
+    Return the ``MULTITENANCY_CACHE``, which must be shared between processes for
+    the fingerprint and lock used by sync_backend_links_if_changed() to work.
+    """
+    cache = get_cache()
+    if cache is None or isinstance(cache, (DummyCache, LocMemCache)):
+        raise ImproperlyConfigured(
+            "MULTITENANCY_SYNC_BACKEND_LINKS requires MULTITENANCY_CACHE to be set to "
+            "a cache which is shared between processes, such as memcached or the "
+            "database cache."
+        )
+    return cache
+
+
+def sync_backend_links_if_changed(names, using=None):
+    """
+    Run sync_backend_links() unless it already ran for the same backend names.
+
+    The fingerprint of the names last synced is kept in ``MULTITENANCY_CACHE``, with
+    a lock so that when many processes start at once only one of them does the sync.
+    Raises ImproperlyConfigured if that cache isn't shared between processes.
+    Returns the names of the backends which got a new BackendLink, or None if the
+    sync was skipped.
+    """
+    cache = get_shared_cache()
+    using = using or router.db_for_write(BackendLink)
+    fingerprint = get_fingerprint(names)
+    key = make_key('backend-links', using, settings.DATABASES[using]['NAME'])
+    if cache.get(key) == fingerprint:
+        return None
+    lock_key = make_key('backend-links-lock', using, settings.DATABASES[using]['NAME'])
+    if not cache.add(lock_key, fingerprint, SYNC_LOCK_TIMEOUT):
+        # another process is doing the sync
+        return None
+    try:
+        added = sync_backend_links(names, using=using)
+        cache.set(key, fingerprint, None)
+    finally:
+        cache.delete(lock_key)
+    return added
+
+
+def sync_installed_backends():
+    """
+    Make sure each of the ``INSTALLED_BACKENDS`` has a BackendLink, as the
+    update_backend_links command does. Called at startup if
+    ``MULTITENANCY_SYNC_BACKEND_LINKS`` is set.
+    """
+    from rapidsms.conf import settings as rapidsms_settings
+
+    try:
+        added = sync_backend_links_if_changed(rapidsms_settings.INSTALLED_BACKENDS)
+    except DatabaseError:
+        # e.g. the tables don't exist yet because migrate is being run
+        logger.warning("Could not sync the backend links", exc_info=True)
+        return
+    for name in added or ():
+        logger.info("Added multitenant backend link %s", name)
@@ -1,11 +1,17 @@
+import json
+
 from django.contrib import admin
+from django.core.urlresolvers import reverse
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
 from mock import Mock
 from model_mommy import mommy
+from rapidsms.models import Backend
 
 from ..admin import TenantAdmin, TenantGroupAdmin
-from ..models import Tenant, TenantGroup, TenantRole
+from ..models import BackendLink, Tenant, TenantGroup, TenantRole
 
 
 class TenantGroupAdminTestCase(TestCase):
@@ -111,6 +117,29 @@ class TenantAdminTestCase(TestCase):
         self.assertNotIn(other_tenant_in_tenant1_group, qs)
         self.assertNotIn(other_tenant, qs)
 
+    def test_manager_with_several_roles_sees_tenants_once(self):
+        """Overlapping roles should not produce duplicate rows."""
+        mommy.make('TenantRole', group=self.tenant.group,
+                   user=self.user, role=TenantRole.ROLE_GROUP_MANAGER)
+        mommy.make('TenantRole', group=self.tenant.group, tenant=self.tenant,
+                   user=self.user, role=TenantRole.ROLE_TENANT_MANAGER)
+        qs = self.get_tenant_admin_queryset()
+        self.assertEqual(list(qs), [self.tenant])
+
+    def test_group_choices_limited_to_users_groups(self):
+        """Non superusers can only pick groups they have a role in."""
+        other_group = mommy.make('TenantGroup')
+        mommy.make('TenantRole', group=self.tenant.group,
+                   user=self.user, role=TenantRole.ROLE_GROUP_MANAGER)
+        mommy.make('TenantRole', group=self.tenant.group, tenant=self.tenant,
+                   user=self.user, role=TenantRole.ROLE_TENANT_MANAGER)
+        tenant_admin = TenantAdmin(Tenant, admin.site)
+        request = Mock()
+        request.user = self.user
+        field = tenant_admin.formfield_for_foreignkey(Tenant._meta.get_field('group'), request)
+        self.assertEqual(list(field.queryset), [self.tenant.group])
+        self.assertNotIn(other_group, field.queryset)
+
     def test_superuser_sees_all_tenants_even_if_also_a_manager(self):
         """Superusers should see all tenants, even if they are also a Manager"""
         other_tenant = mommy.make('Tenant')
@@ -121,3 +150,134 @@ class TenantAdminTestCase(TestCase):
         qs = self.get_tenant_admin_queryset()
         self.assertIn(self.tenant, qs)
         self.assertIn(other_tenant, qs)
+
+
+class BackendLinksViewTestCase(TestCase):
+
+    def setUp(self):
+        self.user = mommy.make('User', is_staff=True, is_superuser=True)
+        self.user.set_password('test')
+        self.user.save()
+        self.client.login(username=self.user.username, password='test')
+        self.url = reverse('admin:multitenancy_tenant_backend_links')
+        self.tenant = mommy.make('Tenant')
+
+    def make_link(self, name, tenant=None):
+        return mommy.make('BackendLink', backend=mommy.make('Backend', name=name), tenant=tenant)
+
+    def get_results(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_same_choices_as_form(self):
+        own = self.make_link('own', tenant=self.tenant)
+        unassigned = self.make_link('unassigned')
+        self.make_link('mt_tester')
+        self.make_link('mt_own', tenant=self.tenant)
+        self.make_link('other', tenant=mommy.make('Tenant'))
+        data = self.get_results(tenant=self.tenant.pk)
+        self.assertEqual(data['results'], [{'id': own.pk, 'text': 'own'},
+                                           {'id': unassigned.pk, 'text': 'unassigned'}])
+        self.assertFalse(data['more'])
+        data = self.get_results()
+        self.assertEqual(data['results'], [{'id': unassigned.pk, 'text': 'unassigned'}])
+
+    def test_search(self):
+        self.make_link('alpha')
+        beta = self.make_link('beta')
+        data = self.get_results(q='ET')
+        self.assertEqual(data['results'], [{'id': beta.pk, 'text': 'beta'}])
+
+    def test_pages(self):
+        for i in range(TenantAdmin.backend_links_per_page + 5):
+            self.make_link('backend-%02d' % i)
+        first = self.get_results()
+        self.assertEqual(len(first['results']), TenantAdmin.backend_links_per_page)
+        self.assertTrue(first['more'])
+        second = self.get_results(page=2)
+        self.assertEqual([result['text'] for result in second['results']],
+                         ['backend-%02d' % i for i in range(20, 25)])
+        self.assertFalse(second['more'])
+        self.assertEqual(self.get_results(page='x'), first)
+
+    def test_unknown_tenant(self):
+        response = self.client.get(self.url, {'tenant': 0})
+        self.assertEqual(response.status_code, 404)
+
+    def test_requires_permission(self):
+        user = mommy.make('User', is_staff=True)
+        user.set_password('test')
+        user.save()
+        self.client.login(username=user.username, password='test')
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 403)
+
+
+class ChangelistQueriesTestCase(TestCase):
+    """The changelists need the same number of queries regardless of the number of tenants."""
+
+    def setUp(self):
+        self.user = mommy.make('User', is_staff=True, is_superuser=True)
+        self.user.set_password('test')
+        self.user.save()
+        self.client.login(username=self.user.username, password='test')
+
+    def seed(self, groups, tenants_per_group):
+        """Create many tenants, each with a backend, without going through save()."""
+        start = TenantGroup.objects.count()
+        TenantGroup.objects.bulk_create([
+            TenantGroup(name='group-%d' % i, slug='group-%d' % i, normalized_slug='group-%d' % i)
+            for i in range(start, start + groups)
+        ])
+        self.add_tenants(TenantGroup.objects.order_by('-pk')[:groups], tenants_per_group)
+
+    def add_tenants(self, groups, tenants_per_group):
+        start = Tenant.objects.count()
+        Tenant.objects.bulk_create([
+            Tenant(name='tenant-%d' % i, slug='tenant-%d' % i, normalized_slug='tenant-%d' % i, group=group)
+            for group in groups for i in range(start, start + tenants_per_group)
+        ])
+        Backend.objects.bulk_create([
+            Backend(name='backend-%d' % tenant_id)
+            for tenant_id in Tenant.objects.filter(backendlink__isnull=True).values_list('pk', flat=True)
+        ])
+        backends = dict(Backend.objects.filter(tenantlink__isnull=True).values_list('name', 'pk'))
+        BackendLink.all_tenants.bulk_create([
+            BackendLink(tenant_id=tenant_id, backend_id=backends['backend-%d' % tenant_id])
+            for tenant_id in Tenant.objects.filter(backendlink__isnull=True).values_list('pk', flat=True)
+        ])
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_tenant_changelist(self):
+        url = reverse('admin:multitenancy_tenant_changelist')
+        self.seed(groups=1, tenants_per_group=2)
+        small = self.count_queries(url)
+        self.seed(groups=50, tenants_per_group=100)
+        self.assertGreaterEqual(Tenant.objects.count(), 5000)
+        self.assertEqual(self.count_queries(url), small)
+
+    def test_tenant_group_changelist(self):
+        url = reverse('admin:multitenancy_tenantgroup_changelist')
+        self.seed(groups=2, tenants_per_group=1)
+        small = self.count_queries(url)
+        self.seed(groups=200, tenants_per_group=25)
+        self.assertGreaterEqual(Tenant.objects.count(), 5000)
+        self.assertEqual(self.count_queries(url), small)
+
+    def test_tenant_group_change_view(self):
+        """The inline TenantForms share a single query for their backend link choices."""
+        group = mommy.make('TenantGroup')
+        url = reverse('admin:multitenancy_tenantgroup_change', args=(group.pk, ))
+        mommy.make('BackendLink', _quantity=3)
+        self.add_tenants([group], 2)
+        # warm up the per-process caches
+        self.count_queries(url)
+        small = self.count_queries(url)
+        self.add_tenants([group], 50)
+        self.assertEqual(self.count_queries(url), small)
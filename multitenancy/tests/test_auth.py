@@ -1,9 +1,21 @@
-from django.test import TestCase
+import time
 
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.signals import request_finished
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+
+from mock import patch
 from model_mommy import mommy
 
 from .. import models
-from ..auth import TenantRolesBackend
+from ..auth import (RoleIndex, TenantRolesBackend, can_access_group, can_access_tenant,
+                    filter_permitted, get_decision_cache, get_object_resolver,
+                    get_user_group_ids, get_user_roles, get_user_tenant_ids, has_perms_for_objects,
+                    is_group_manager, is_related_app, is_tenant_manager, parse_permission, role_version_name)
+from ..cache import get_version, make_key
 
 
 class RolePermissionsTestCase(TestCase):
@@ -169,3 +181,351 @@ class RolePermissionsTestCase(TestCase):
 
         self.assertTrue(self.backend.has_module_perms(self.user, 'multitenancy'))
         self.assertFalse(self.backend.has_module_perms(self.user, 'auth'))
+
+
+class PermissionParsingTestCase(TestCase):
+    """Parsing of permission strings and app labels."""
+
+    def test_parse_permission(self):
+        self.assertEqual(parse_permission('multitenancy.change_tenant'), ('change', models.Tenant, True))
+        self.assertEqual(parse_permission('multitenancy.add_backendlink'),
+                         ('add', models.BackendLink, False))
+        # Parsed results are cached
+        self.assertIs(parse_permission('multitenancy.change_tenant'),
+                      parse_permission('multitenancy.change_tenant'))
+
+    def test_is_related_app(self):
+        self.assertTrue(is_related_app('multitenancy'))
+        self.assertFalse(is_related_app('auth'))
+
+
+class AccessibleIdsTestCase(TestCase):
+    """Materialized sets of the groups and tenants a user can access."""
+
+    def setUp(self):
+        self.group, self.other_group = mommy.make('TenantGroup', _quantity=2)
+        self.tenant, self.other_tenant = mommy.make('Tenant', group=self.group, _quantity=2)
+        self.user = mommy.make('User', is_staff=True)
+
+    def test_tenant_manager_needs_no_queries(self):
+        mommy.make('TenantRole',
+                   group=self.group, tenant=self.tenant, user=self.user,
+                   role=models.TenantRole.ROLE_TENANT_MANAGER)
+        get_user_roles(self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_user_group_ids(self.user), {self.group.pk})
+            self.assertEqual(get_user_tenant_ids(self.user, self.group), {self.tenant.pk})
+            self.assertEqual(get_user_tenant_ids(self.user, self.other_group), set())
+
+    def test_group_manager(self):
+        mommy.make('TenantRole',
+                   group=self.group, user=self.user,
+                   role=models.TenantRole.ROLE_GROUP_MANAGER)
+        self.assertEqual(get_user_group_ids(self.user), {self.group.pk})
+        self.assertEqual(get_user_tenant_ids(self.user, self.group), {self.tenant.pk, self.other_tenant.pk})
+
+    def test_superuser(self):
+        self.user.is_superuser = True
+        self.assertEqual(get_user_group_ids(self.user), {self.group.pk, self.other_group.pk})
+        self.assertEqual(get_user_tenant_ids(self.user, self.group), {self.tenant.pk, self.other_tenant.pk})
+
+    def test_inactive(self):
+        self.user.is_active = False
+        self.assertEqual(get_user_group_ids(self.user), set())
+        self.assertEqual(get_user_tenant_ids(self.user, self.group), set())
+
+
+class AccessChecksTestCase(TestCase):
+    """Checking access to a single group or tenant needs no queries."""
+
+    def setUp(self):
+        self.group, self.other_group = mommy.make('TenantGroup', _quantity=2)
+        self.tenant, self.other_tenant = mommy.make('Tenant', group=self.group, _quantity=2)
+        self.user = mommy.make('User', is_staff=True)
+
+    def test_superuser(self):
+        self.user.is_superuser = True
+        with self.assertNumQueries(0):
+            self.assertTrue(can_access_group(self.user, self.group.pk))
+            self.assertTrue(can_access_tenant(self.user, self.tenant))
+
+    def test_group_manager(self):
+        mommy.make('TenantRole',
+                   group=self.group, user=self.user,
+                   role=models.TenantRole.ROLE_GROUP_MANAGER)
+        get_user_roles(self.user)
+        with self.assertNumQueries(0):
+            self.assertTrue(can_access_group(self.user, self.group.pk))
+            self.assertFalse(can_access_group(self.user, self.other_group.pk))
+            self.assertTrue(can_access_tenant(self.user, self.other_tenant))
+
+    def test_tenant_manager(self):
+        mommy.make('TenantRole',
+                   group=self.group, tenant=self.tenant, user=self.user,
+                   role=models.TenantRole.ROLE_TENANT_MANAGER)
+        self.assertTrue(can_access_group(self.user, self.group.pk))
+        self.assertTrue(can_access_tenant(self.user, self.tenant))
+        self.assertFalse(can_access_tenant(self.user, self.other_tenant))
+
+    def test_inactive(self):
+        self.user.is_superuser = True
+        self.user.is_active = False
+        self.assertFalse(can_access_group(self.user, self.group.pk))
+        self.assertFalse(can_access_tenant(self.user, self.tenant))
+
+
+class RoleIndexTestCase(TestCase):
+    """Lookups over a user's roles."""
+
+    def setUp(self):
+        self.index = RoleIndex([
+            (1, models.TenantRole.ROLE_GROUP_MANAGER, None),
+            (2, models.TenantRole.ROLE_TENANT_MANAGER, 20),
+        ])
+
+    def test_group_manager(self):
+        self.assertTrue(self.index.is_group_manager())
+        self.assertTrue(self.index.is_group_manager(1))
+        self.assertFalse(self.index.is_group_manager(2))
+
+    def test_tenant_manager(self):
+        self.assertTrue(self.index.is_tenant_manager())
+        self.assertTrue(self.index.is_tenant_manager(group=2))
+        self.assertTrue(self.index.is_tenant_manager(tenant=20))
+        self.assertTrue(self.index.is_tenant_manager(group=2, tenant=20))
+        self.assertFalse(self.index.is_tenant_manager(group=1))
+        self.assertFalse(self.index.is_tenant_manager(group=1, tenant=20))
+        self.assertFalse(self.index.is_tenant_manager(tenant=10))
+
+    def test_no_roles(self):
+        index = RoleIndex([])
+        self.assertFalse(index.is_group_manager())
+        self.assertFalse(index.is_tenant_manager())
+
+
+@override_settings(MULTITENANCY_CACHE='default')
+class RoleCacheTestCase(TestCase):
+    """Roles are cached between requests when a shared cache is configured."""
+
+    def setUp(self):
+        caches['default'].clear()
+        self.group = mommy.make('TenantGroup')
+        self.tenant = mommy.make('Tenant', group=self.group)
+        self.user = mommy.make('User', is_staff=True)
+        mommy.make('TenantRole',
+                   group=self.group, user=self.user,
+                   role=models.TenantRole.ROLE_GROUP_MANAGER)
+
+    def fresh_user(self, user=None):
+        """Simulate the user being loaded for a new request."""
+        return get_user_model().objects.get(pk=(user or self.user).pk)
+
+    def test_roles_cached_between_requests(self):
+        expected = get_user_roles(self.fresh_user())
+        user = self.fresh_user()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_user_roles(user), expected)
+
+    def test_new_role_invalidates_cache(self):
+        get_user_roles(self.fresh_user())
+        mommy.make('TenantRole',
+                   group=self.group, tenant=self.tenant, user=self.user,
+                   role=models.TenantRole.ROLE_TENANT_MANAGER)
+        self.assertTrue(is_tenant_manager(self.fresh_user(), tenant=self.tenant.pk))
+
+    def test_deleted_role_invalidates_cache(self):
+        self.assertTrue(is_group_manager(self.fresh_user()))
+        models.TenantRole.objects.filter(user=self.user).delete()
+        self.assertFalse(is_group_manager(self.fresh_user()))
+
+    def test_reassigned_role_invalidates_previous_user(self):
+        self.assertTrue(is_group_manager(self.fresh_user()))
+        other = mommy.make('User', is_staff=True)
+        role = models.TenantRole.objects.get(user=self.user)
+        role.user = other
+        role.save()
+        self.assertFalse(is_group_manager(self.fresh_user()))
+        self.assertTrue(is_group_manager(self.fresh_user(other)))
+
+
+@override_settings(MULTITENANCY_CACHE='default')
+class RoleCacheCommitTestCase(TransactionTestCase):
+    """Roles cached by other requests before a change is committed aren't kept."""
+
+    def setUp(self):
+        caches['default'].clear()
+        self.group = mommy.make('TenantGroup')
+        self.user = mommy.make('User', is_staff=True)
+        self.role = mommy.make('TenantRole', group=self.group, user=self.user,
+                               role=models.TenantRole.ROLE_GROUP_MANAGER)
+        self.roles = get_user_roles(get_user_model().objects.get(pk=self.user.pk))
+
+    def delete_role_while_other_request_reads(self):
+        """Delete the role, while another request caches the committed roles under the new version."""
+        with transaction.atomic():
+            self.role.delete()
+            version = get_version(role_version_name(self.user.pk))
+            caches['default'].set(make_key('roles', self.user.pk, version), self.roles)
+        return version
+
+    def test_version_bumped_after_commit(self):
+        version = self.delete_role_while_other_request_reads()
+        self.assertNotEqual(get_version(role_version_name(self.user.pk)), version)
+        self.assertFalse(is_group_manager(get_user_model().objects.get(pk=self.user.pk)))
+
+    def test_version_bumped_at_end_of_request(self):
+        version = self.delete_role_while_other_request_reads()
+        request_finished.send(sender=self.__class__)
+        key = 'multitenancy:version:{}'.format(role_version_name(self.user.pk))
+        self.assertNotEqual(caches['default'].get(key), version)
+
+
+class ObjectResolverTestCase(TestCase):
+    """Finding the group and tenant of objects for permission checks."""
+
+    def setUp(self):
+        self.backend = TenantRolesBackend()
+        self.group = mommy.make('TenantGroup')
+        self.tenant = mommy.make('Tenant', group=self.group)
+        self.user = mommy.make('User', is_staff=True)
+        mommy.make('TenantRole',
+                   group=self.group, user=self.user,
+                   role=models.TenantRole.ROLE_GROUP_MANAGER)
+
+    def test_resolve_tenant_enabled_object(self):
+        link = mommy.make('BackendLink', tenant=self.tenant)
+        resolver = get_object_resolver(models.BackendLink)
+        self.assertEqual(resolver(link), (self.group.pk, self.tenant.pk))
+        self.assertIs(get_object_resolver(models.BackendLink), resolver)
+
+    def test_resolve_object_without_tenant(self):
+        link = mommy.make('BackendLink')
+        self.assertEqual(get_object_resolver(models.BackendLink)(link), (None, None))
+
+    def test_permission_check_needs_no_queries(self):
+        link = mommy.make('BackendLink', tenant=self.tenant)
+        self.assertTrue(self.backend.has_perm(self.user, 'multitenancy.change_backendlink', link))
+        link = models.BackendLink.all_tenants.get(pk=link.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(self.backend.has_perm(self.user, 'multitenancy.change_backendlink', link))
+
+    def test_tenant_moved_by_other_process_is_seen_after_timeout(self):
+        link = mommy.make('BackendLink', tenant=self.tenant)
+        self.assertTrue(self.backend.has_perm(self.user, 'multitenancy.change_backendlink', link))
+        # update() sends no signals, as if the change was made by another process
+        models.Tenant.objects.filter(pk=self.tenant.pk).update(group=mommy.make('TenantGroup'))
+        with patch('time.time', return_value=time.time() + 61):
+            self.assertFalse(self.backend.has_perm(self.user, 'multitenancy.change_backendlink', link))
+
+
+class BulkPermissionsTestCase(TestCase):
+    """Permission checks for many objects at once."""
+
+    def setUp(self):
+        self.backend = TenantRolesBackend()
+        self.group, self.other_group = mommy.make('TenantGroup', _quantity=2)
+        self.tenant = mommy.make('Tenant', group=self.group)
+        self.other_tenant = mommy.make('Tenant', group=self.group)
+        self.foreign_tenant = mommy.make('Tenant', group=self.other_group)
+        self.user = mommy.make('User', is_staff=True)
+
+    def assertMatchesHasPerm(self, perm, queryset):
+        """filter_permitted should agree with has_perm for every object."""
+        expected = set(obj.pk for obj in queryset if self.backend.has_perm(self.user, perm, obj))
+        found = set(filter_permitted(self.user, perm, queryset).values_list('pk', flat=True))
+        self.assertEqual(found, expected)
+        results = has_perms_for_objects(self.user, perm, queryset)
+        self.assertEqual(set(obj.pk for obj, allowed in results.items() if allowed), expected)
+
+    def assertAllMatchHasPerm(self):
+        self.assertMatchesHasPerm('multitenancy.change_tenantgroup', models.TenantGroup.objects.all())
+        self.assertMatchesHasPerm('multitenancy.change_tenant', models.Tenant.objects.all())
+        self.assertMatchesHasPerm('multitenancy.change_tenantrole', models.TenantRole.objects.all())
+        self.assertMatchesHasPerm('multitenancy.change_backendlink', models.BackendLink.all_tenants.all())
+
+    def make_objects(self):
+        mommy.make('TenantRole', group=self.other_group, role=models.TenantRole.ROLE_GROUP_MANAGER)
+        mommy.make('TenantRole', group=self.group, tenant=self.other_tenant,
+                   role=models.TenantRole.ROLE_TENANT_MANAGER)
+        for tenant in (self.tenant, self.other_tenant, self.foreign_tenant, None):
+            mommy.make('BackendLink', tenant=tenant)
+
+    def test_group_manager(self):
+        mommy.make('TenantRole',
+                   group=self.other_group, user=self.user,
+                   role=models.TenantRole.ROLE_GROUP_MANAGER)
+        self.make_objects()
+        self.assertAllMatchHasPerm()
+
+    def test_tenant_manager(self):
+        mommy.make('TenantRole',
+                   group=self.group, tenant=self.tenant, user=self.user,
+                   role=models.TenantRole.ROLE_TENANT_MANAGER)
+        self.make_objects()
+        self.assertAllMatchHasPerm()
+
+    def test_no_roles(self):
+        self.make_objects()
+        self.assertAllMatchHasPerm()
+        self.assertFalse(filter_permitted(self.user, 'multitenancy.change_tenant',
+                                          models.Tenant.objects.all()).exists())
+
+    def test_superuser_and_inactive(self):
+        queryset = models.Tenant.objects.all()
+        self.user.is_superuser = True
+        self.assertEqual(filter_permitted(self.user, 'multitenancy.change_tenant', queryset).count(), 3)
+        self.user.is_active = False
+        self.assertEqual(filter_permitted(self.user, 'multitenancy.change_tenant', queryset).count(), 0)
+
+
+@override_settings(MULTITENANCY_PERMISSION_CACHE_SIZE=100)
+class DecisionCacheTestCase(TestCase):
+    """Permission decisions can be cached per process."""
+
+    def setUp(self):
+        self.backend = TenantRolesBackend()
+        self.group = mommy.make('TenantGroup')
+        self.tenant = mommy.make('Tenant', group=self.group)
+        self.user = mommy.make('User', is_staff=True)
+        self.cache = get_decision_cache()
+
+    def fresh_user(self):
+        return get_user_model().objects.get(pk=self.user.pk)
+
+    def test_decisions_are_cached(self):
+        self.assertFalse(self.backend.has_perm(self.fresh_user(), 'multitenancy.change_tenant', self.tenant))
+        self.assertFalse(self.backend.has_perm(self.fresh_user(), 'multitenancy.change_tenant', self.tenant))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_role_changes_invalidate_decisions(self):
+        self.assertFalse(self.backend.has_perm(self.fresh_user(), 'multitenancy.change_tenant', self.tenant))
+        mommy.make('TenantRole',
+                   group=self.group, tenant=self.tenant, user=self.user,
+                   role=models.TenantRole.ROLE_TENANT_MANAGER)
+        self.assertTrue(self.backend.has_perm(self.fresh_user(), 'multitenancy.change_tenant', self.tenant))
+
+    def test_tenant_changes_invalidate_decisions(self):
+        mommy.make('TenantRole',
+                   group=self.group, user=self.user,
+                   role=models.TenantRole.ROLE_GROUP_MANAGER)
+        link = mommy.make('BackendLink', tenant=self.tenant)
+        self.assertTrue(self.backend.has_perm(self.fresh_user(), 'multitenancy.change_backendlink', link))
+        self.tenant.group = mommy.make('TenantGroup')
+        self.tenant.save()
+        self.assertFalse(self.backend.has_perm(self.fresh_user(), 'multitenancy.change_backendlink', link))
+
+    def test_moved_objects_are_checked_again(self):
+        mommy.make('TenantRole',
+                   group=self.group, user=self.user,
+                   role=models.TenantRole.ROLE_GROUP_MANAGER)
+        link = mommy.make('BackendLink', tenant=self.tenant)
+        user = self.fresh_user()
+        self.assertTrue(self.backend.has_perm(user, 'multitenancy.change_backendlink', link))
+        link.tenant = mommy.make('Tenant')
+        link.save()
+        self.assertFalse(self.backend.has_perm(user, 'multitenancy.change_backendlink', link))
+        self.assertFalse(self.backend._has_perm(user, 'multitenancy.change_backendlink', link))
+
+    def test_disabled_by_default(self):
+        with self.settings(MULTITENANCY_PERMISSION_CACHE_SIZE=0):
+            self.assertIsNone(get_decision_cache())
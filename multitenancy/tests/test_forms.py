@@ -1,8 +1,12 @@
+from django.db import connection
+from django.forms.models import inlineformset_factory
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 
 from model_mommy import mommy
 
-from ..forms import TenantForm
+from ..forms import BackendLinkLookupWidget, TenantForm, TenantFormSet
+from ..models import Tenant, TenantGroup
 
 
 class TenantFormTest(TestCase):
@@ -20,6 +24,13 @@ class TenantFormTest(TestCase):
         self.assertIn(backend_link.backend.name,
                       [choice[1] for choice in form.fields['backend_link'].choices])
 
+    def test_form_doesnt_display_message_tester_backends(self):
+        mommy.make('BackendLink', backend=mommy.make('Backend', name='mt_tester'))
+        form = TenantForm()
+        available_backends = [choice for choice, value in list(form.fields['backend_link'].choices)
+                              if choice != '']
+        self.assertEqual(available_backends, [])
+
     def test_form_doesnt_display_used_backends(self):
         """If a backend is already associated with a Tenant, it cannot be reused"""
         backend_link = mommy.make('BackendLink')
@@ -73,3 +84,121 @@ class TenantFormTest(TestCase):
         self.assertNotIn(old_link, updated_tenant.backendlink_set.all())
         # it should add requested backends
         self.assertIn(new_link, updated_tenant.backendlink_set.all())
+
+    def test_saving_unchanged_link_doesnt_update_links(self):
+        """The tenant keeps its link throughout, it is never unlinked and linked again."""
+        backend_link = mommy.make('BackendLink')
+        tenant = mommy.make('Tenant', backendlink_set=[backend_link])
+        form = TenantForm(
+            instance=tenant,
+            data={
+                'name': 'newname',
+                'slug': tenant.slug,
+                'group': tenant.group.pk,
+                'backend_link': backend_link.pk,
+            })
+        self.assertTrue(form.is_valid(), form.errors)
+        with CaptureQueriesContext(connection) as queries:
+            form.save()
+        updates = [query['sql'] for query in queries
+                   if 'UPDATE' in query['sql'] and 'multitenancy_backendlink' in query['sql']]
+        self.assertEqual(updates, [])
+        self.assertEqual(list(tenant.backendlink_set.all()), [backend_link])
+
+
+class TenantFormLookupTest(TestCase):
+
+    def test_only_selected_link_is_rendered(self):
+        links = mommy.make('BackendLink', _quantity=5)
+        tenant = mommy.make('Tenant')
+        tenant.backendlink_set.add(links[0])
+        form = TenantForm(instance=tenant)
+        self.assertIsInstance(form.fields['backend_link'].widget, BackendLinkLookupWidget)
+        with self.assertNumQueries(0):
+            html = str(form['backend_link'])
+        self.assertIn(links[0].backend.name, html)
+        for link in links[1:]:
+            self.assertNotIn(link.backend.name, html)
+        self.assertIn('?tenant={}'.format(tenant.pk), html)
+
+    def test_submitted_link_is_rendered(self):
+        group = mommy.make('TenantGroup')
+        link = mommy.make('BackendLink')
+        form = TenantForm(data={'name': '', 'slug': 'slug', 'group': group.pk, 'backend_link': link.pk})
+        self.assertFalse(form.is_valid())
+        self.assertIn(link.backend.name, str(form['backend_link']))
+
+    def test_lookup_keeps_validation_rules(self):
+        group = mommy.make('TenantGroup')
+        tester = mommy.make('BackendLink', backend=mommy.make('Backend', name='mt_tester'))
+        form = TenantForm(data={'name': 'name', 'slug': 'slug', 'group': group.pk,
+                                'backend_link': tester.pk})
+        self.assertFalse(form.is_valid())
+        self.assertIn('backend_link', form.errors)
+
+    @override_settings(ROOT_URLCONF='multitenancy.urls')
+    def test_select_without_admin(self):
+        link = mommy.make('BackendLink')
+        form = TenantForm()
+        self.assertNotIsInstance(form.fields['backend_link'].widget, BackendLinkLookupWidget)
+        self.assertIn(link.backend.name, str(form['backend_link']))
+
+
+@override_settings(ROOT_URLCONF='multitenancy.urls')
+class TenantFormSetTest(TestCase):
+
+    def setUp(self):
+        self.group = mommy.make('TenantGroup')
+        self.tenants = mommy.make('Tenant', group=self.group, _quantity=3)
+        for tenant in self.tenants:
+            mommy.make('BackendLink', tenant=tenant)
+        mommy.make('BackendLink', tenant=self.tenants[0],
+                   backend=mommy.make('Backend', name='mt_tester'))
+        mommy.make('BackendLink', _quantity=2)
+        self.FormSet = inlineformset_factory(TenantGroup, Tenant, form=TenantForm,
+                                             formset=TenantFormSet, extra=1)
+
+    def test_choices_match_unshared_forms(self):
+        formset = self.FormSet(instance=self.group)
+        for form in formset.forms:
+            expected = TenantForm(instance=form.instance).fields['backend_link']
+            self.assertEqual(list(form.fields['backend_link'].choices), list(expected.choices))
+            self.assertEqual(form.fields['backend_link'].initial, expected.initial)
+
+    def test_choices_loaded_once(self):
+        formset = self.FormSet(instance=self.group)
+        with self.assertNumQueries(3):
+            # one query for the tenants, one for their links and one for the unassigned links
+            forms = formset.forms
+            for form in forms + [formset.empty_form]:
+                list(form.fields['backend_link'].choices)
+
+    def test_submitted_link_is_validated(self):
+        tenant = self.tenants[1]
+        taken = self.tenants[0].backendlink_set.first()
+        data = {
+            'tenants-TOTAL_FORMS': '1',
+            'tenants-INITIAL_FORMS': '0',
+            'tenants-MAX_NUM_FORMS': '1000',
+            'tenants-0-name': 'new',
+            'tenants-0-slug': 'new',
+            'tenants-0-backend_link': taken.pk,
+        }
+        formset = self.FormSet(instance=tenant.group, data=data, prefix='tenants')
+        self.assertFalse(formset.is_valid())
+
+
+class TenantFormSetLookupTest(TestCase):
+
+    def test_unassigned_links_not_loaded(self):
+        group = mommy.make('TenantGroup')
+        for tenant in mommy.make('Tenant', group=group, _quantity=3):
+            mommy.make('BackendLink', tenant=tenant)
+        mommy.make('BackendLink', _quantity=2)
+        FormSet = inlineformset_factory(TenantGroup, Tenant, form=TenantForm,
+                                        formset=TenantFormSet, extra=1)
+        formset = FormSet(instance=group)
+        with self.assertNumQueries(2):
+            # one query for the tenants and one for their links
+            for form in formset.forms + [formset.empty_form]:
+                str(form['backend_link'])
@@ -45,3 +45,33 @@ class UpdateBackendLinksTest(TestCase):
             call_command('update_backend_links', verbosity=0, stdout=self.output)
         self.assertEqual(BackendLink.all_tenants.count(), 1)
         self.assertEqual(self.output.getvalue(), '')
+
+    def test_adds_missing_links_in_bulk(self):
+        """Existing backends are reused and all missing rows are created in a few queries."""
+        backends = dict(("backend-%d" % i, {}) for i in range(20))
+        existing = mommy.make('Backend', name='backend-0')
+        mommy.make('BackendLink', backend=mommy.make('Backend', name='backend-1'))
+        backends['mt_backend'] = {}
+        with self.settings(INSTALLED_BACKENDS=backends):
+            # 2 to find the existing rows, then 1 to create the backends, 1 to fetch
+            # their ids and 1 to create the links, plus the savepoint or transaction
+            with self.assertNumQueries(7):
+                call_command('update_backend_links', verbosity=0)
+        self.assertEqual(BackendLink.all_tenants.count(), 21)
+        self.assertTrue(BackendLink.all_tenants.filter(backend=existing).exists())
+        tester = BackendLink.all_tenants.get(backend__name='mt_backend')
+        self.assertTrue(tester.is_message_tester)
+        self.assertEqual(BackendLink.all_tenants.filter(is_message_tester=True).count(), 1)
+
+    def test_dry_run(self):
+        with self.settings(INSTALLED_BACKENDS=INSTALLED_BACKENDS):
+            call_command('update_backend_links', dry_run=True, stdout=self.output)
+        self.assertEqual(BackendLink.all_tenants.count(), 0)
+        self.assertEqual(self.output.getvalue(), 'Would add multitenant backend link message_tester\n')
+
+    def test_reports_timing(self):
+        with self.settings(INSTALLED_BACKENDS=INSTALLED_BACKENDS):
+            call_command('update_backend_links', verbosity=2, stdout=self.output)
+        lines = self.output.getvalue().splitlines()
+        self.assertEqual(lines[0], 'Added multitenant backend link message_tester')
+        self.assertRegexpMatches(lines[1], r'^Checked 1 backends in \d+\.\d{3} seconds$')
@@ -94,3 +94,52 @@ class MiddlewareTest(CreateDataMixin, TestCase):
 
         with self.assertRaises(Http404):
             self.call_process_view()
+
+
+class MiddlewareCacheTest(CreateDataMixin, TestCase):
+    """Slug lookups are cached between requests."""
+
+    def setUp(self):
+        self.group = mommy.make('TenantGroup')
+        self.tenant = mommy.make('Tenant', group=self.group)
+        self.mm = MultitenancyMiddleware()
+
+    def call_process_view(self, **view_kwargs):
+        request = mock.Mock()
+        self.mm.process_view(
+            request=request,
+            view_func=mock.Mock(),
+            view_args=[],
+            view_kwargs=view_kwargs
+        )
+        return request
+
+    def test_repeated_lookup_uses_no_queries(self):
+        self.call_process_view(group_slug=self.group.slug, tenant_slug=self.tenant.slug)
+        with self.assertNumQueries(0):
+            request = self.call_process_view(group_slug=self.group.slug.upper(),
+                                             tenant_slug=self.tenant.slug)
+        self.assertEqual(request.tenants, [self.tenant])
+        self.assertEqual(request.tenants[0].group, self.group)
+        self.assertEqual(request.group_slug, self.group.slug)
+
+    def test_missing_tenant_is_cached(self):
+        with self.assertRaises(Http404):
+            self.call_process_view(group_slug=self.group.slug, tenant_slug='missing')
+        with self.assertNumQueries(0):
+            with self.assertRaises(Http404):
+                self.call_process_view(group_slug=self.group.slug, tenant_slug='missing')
+
+    def test_cache_cleared_when_tenant_saved(self):
+        with self.assertRaises(Http404):
+            self.call_process_view(group_slug=self.group.slug, tenant_slug='new-slug')
+        self.tenant.slug = 'new-slug'
+        self.tenant.save()
+        request = self.call_process_view(group_slug=self.group.slug, tenant_slug='new-slug')
+        self.assertEqual(request.tenants, [self.tenant])
+
+    def test_cache_cleared_when_group_deleted(self):
+        self.call_process_view(group_slug=self.group.slug)
+        self.group.delete()
+        with self.assertRaises(Http404):
+            self.call_process_view(group_slug=self.group.slug)
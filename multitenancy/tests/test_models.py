@@ -1,12 +1,15 @@
-from django.db import models, IntegrityError
+from django.core.exceptions import ValidationError
+from django.db import connection, models, transaction, IntegrityError
+from django.db.models.signals import post_save
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
 from model_mommy import mommy
 from rapidsms.backends.database import DatabaseBackend
 from rapidsms.backends.database.models import BackendMessage
 from rapidsms.tests.harness import CustomRouterMixin
 
-from ..models import MultitenantIncompatiblityError, TenantEnabled
+from ..models import BackendLink, MultitenantIncompatiblityError, Tenant, TenantEnabled, TenantGroup
 
 
 class TenantModelTest(TestCase):
@@ -33,6 +36,34 @@ class TenantModelTest(TestCase):
             # but not in the same group
             mommy.make('Tenant', group=g2, name=self.tenant.name, slug=self.tenant.slug)
 
+    def test_normalized_slug(self):
+        """A lowercased copy of the slug is stored for case-insensitive lookups."""
+        self.group.slug = 'Group-Slug'
+        self.group.save()
+        self.tenant.slug = 'Tenant-Slug'
+        self.tenant.save(update_fields=['slug'])
+        self.assertEqual(TenantGroup.objects.get(normalized_slug='group-slug'), self.group)
+        self.assertEqual(Tenant.objects.get(normalized_slug='tenant-slug'), self.tenant)
+
+    def test_slugs_unique_ignoring_case(self):
+        """Slugs only differing by case would make slug lookups ambiguous."""
+        self.group.slug = 'Slug'
+        self.group.save()
+        self.tenant.slug = 'Slug'
+        self.tenant.save()
+        other_group = mommy.make('TenantGroup', slug='other')
+        # the same slug is still fine in another group
+        mommy.make('Tenant', group=other_group, slug='slug')
+        group = TenantGroup(name='another', slug='slug')
+        tenant = Tenant(name='another', slug='slug', group=self.group)
+        for obj in (group, tenant):
+            with self.assertRaises(ValidationError) as cm:
+                obj.full_clean()
+            self.assertIn('slug', cm.exception.message_dict)
+            with self.assertRaises(IntegrityError):
+                with transaction.atomic():
+                    obj.save()
+
 
 class BackendTest(CustomRouterMixin, TestCase):
 
@@ -48,6 +79,15 @@ class BackendTest(CustomRouterMixin, TestCase):
         self.tenant_backend = self.create_backend(data={'name': 'tenant_backend'})
         self.tenant_backend_link = mommy.make('BackendLink', tenant=self.tenant, backend=self.tenant_backend)
 
+    def test_message_tester_flag(self):
+        self.assertFalse(self.tenant_backend_link.is_message_tester)
+        tester_link = mommy.make('BackendLink', backend=mommy.make('Backend', name='mt_tester'))
+        self.assertTrue(tester_link.is_message_tester)
+        # renaming a backend updates the flag of its link
+        self.tenant_backend.name = 'mt_renamed'
+        self.tenant_backend.save()
+        self.assertTrue(BackendLink.all_tenants.get(pk=self.tenant_backend_link.pk).is_message_tester)
+
     def test_get_tenant_assoicated_with_backend(self):
         self.assertEqual(self.tenant_backend_link.tenant, self.tenant)
 
@@ -72,6 +112,79 @@ class BackendTest(CustomRouterMixin, TestCase):
         self.assertEqual(expected_count, BackendMessage.objects.filter(name__in=tenant_backend_names).count())
 
 
+class TenantWithBackendsTest(TestCase):
+    """Backends of many tenants can be prefetched."""
+
+    def setUp(self):
+        self.tenants = mommy.make('Tenant', _quantity=3)
+        for tenant in self.tenants:
+            mommy.make('BackendLink', tenant=tenant, _quantity=2)
+
+    def test_with_backends_uses_two_queries(self):
+        with self.assertNumQueries(2):
+            tenants = list(Tenant.objects.with_backends())
+            names = [tenant.get_backend_names() for tenant in tenants]
+        for tenant, backend_names in zip(tenants, names):
+            self.assertEqual(backend_names, Tenant.objects.get(pk=tenant.pk).get_backend_names())
+
+    def test_get_backends_can_be_filtered_further(self):
+        tenant = Tenant.objects.with_backends().get(pk=self.tenants[0].pk)
+        backend = tenant.get_backends()[0]
+        self.assertEqual(list(tenant.get_backends().exclude(pk=backend.pk)), list(tenant.get_backends())[1:])
+
+    def test_add_backend_uses_prefetched_backends(self):
+        tenant = Tenant.objects.with_backends().get(pk=self.tenants[0].pk)
+        with self.assertNumQueries(0):
+            tenant.add_backend(tenant.get_backends()[0])
+        backend = mommy.make('Backend')
+        tenant.add_backend(backend)
+        self.assertIn(backend, tenant.get_backends())
+
+
+class TenantSaveBackendsTest(TestCase):
+    """Tenant.save only touches the backend links which change."""
+
+    def setUp(self):
+        self.tenant = mommy.make('Tenant')
+        self.link, self.other_link = mommy.make('BackendLink', _quantity=2)
+        self.tenant.unsaved_backendlinks = [self.link]
+        self.tenant.save()
+
+    def linked(self):
+        return set(self.tenant.backendlink_set.all())
+
+    def test_unchanged_links_are_not_updated(self):
+        self.assertEqual(self.linked(), {self.link})
+        # UPDATE of the tenant and SELECT of its links, plus transaction savepoints
+        with self.assertNumQueries(4):
+            self.tenant.save()
+        self.assertEqual(self.linked(), {self.link})
+
+    def test_links_are_replaced(self):
+        self.tenant.unsaved_backendlinks = [self.other_link]
+        self.tenant.save()
+        self.assertEqual(self.linked(), {self.other_link})
+
+    def test_saving_without_links_clears_them(self):
+        del self.tenant.unsaved_backendlinks
+        self.tenant.save()
+        self.assertEqual(self.linked(), set())
+
+    def test_message_tester_links_added_by_post_save_are_kept(self):
+        tester = mommy.make('Backend', name='mt_tester')
+
+        def add_tester_backend(sender, instance, **kwargs):
+            instance.add_backend(tester)
+
+        post_save.connect(add_tester_backend, sender=Tenant)
+        try:
+            self.tenant.unsaved_backendlinks = [self.other_link]
+            self.tenant.save()
+        finally:
+            post_save.disconnect(add_tester_backend, sender=Tenant)
+        self.assertEqual(set(self.tenant.get_backends()), {tester, self.other_link.backend})
+
+
 class TestModel(TenantEnabled):
     """A Test Model that inherits from TenantEnabled so we can test functionality."""
     name = models.CharField(max_length=20)
@@ -149,6 +262,43 @@ class TenantEnabledTest(TestCase):
                 TestModel(name='two'),
             ])
 
+    def test_by_tenant_id(self):
+        with self.assertNumQueries(1):
+            instances = list(TestModel.objects.by_tenant(self.tenant.pk))
+        self.assertEqual(instances, [self.instance])
+
+    def test_tenant_attribute(self):
+        """The deprecated tenant attribute still gives the Tenant."""
+        with self.assertNumQueries(0):
+            self.assertIs(TestModel.objects.by_tenant(self.tenant).filter(name='x').tenant, self.tenant)
+        qs = TestModel.objects.by_tenant(self.tenant.pk).filter(name='x')
+        with self.assertNumQueries(1):
+            self.assertEqual(qs.tenant, self.tenant)
+            self.assertEqual(qs.tenant, self.tenant)
+        self.assertIsNone(TestModel.objects.by_group(self.tenant.group).tenant)
+
+    def test_create_by_tenant_id(self):
+        with self.assertNumQueries(1):
+            instance = TestModel.objects.by_tenant(self.tenant.pk).create(tenant=self.tenant)
+        self.assertEqual(instance.tenant_id, self.tenant.pk)
+        instance, created = TestModel.objects.by_tenant(self.tenant.pk).get_or_create(
+            name='blah', tenant_id=self.tenant.pk)
+        self.assertTrue(created)
+        self.assertEqual(instance.tenant, self.tenant)
+        with self.assertRaises(MultitenantIncompatiblityError):
+            TestModel.objects.by_tenant(self.tenant.pk).create(tenant_id=self.other_tenant.pk)
+
+    def test_bulk_create_compares_tenant_ids(self):
+        objs = [TestModel(name='one', tenant_id=self.tenant.pk), TestModel(name='two')]
+        with self.assertNumQueries(1):
+            TestModel.objects.by_tenant(self.tenant.pk).bulk_create(objs)
+        self.assertEqual(TestModel.objects.by_tenant(self.tenant).count(), 3)
+        with self.assertNumQueries(0):
+            with self.assertRaises(MultitenantIncompatiblityError):
+                TestModel.objects.by_tenant(self.tenant.pk).bulk_create([
+                    TestModel(name='three', tenant_id=self.other_tenant.pk),
+                ])
+
     def test_filter(self):
         instances = TestModel.objects.by_tenant(self.tenant).filter(name='My Name')
         self.assertEqual(len(instances), 1)
@@ -197,3 +347,76 @@ class TenantEnabledTest(TestCase):
         exists = TestModel.objects.by_tenant(self.tenant).exists()
         self.assertFalse(exists)
         self.assertEqual(TestModel.all_tenants.count(), 1)
+
+
+class TenantEnabledGroupTest(TestCase):
+
+    def setUp(self):
+        self.group = mommy.make('TenantGroup')
+        self.tenants = mommy.make('Tenant', group=self.group, _quantity=3)
+        self.other_tenant = mommy.make('Tenant')
+        for tenant in self.tenants + [self.other_tenant]:
+            TestModel.all_tenants.create(name=tenant.name, tenant=tenant)
+
+    def test_by_tenants(self):
+        tenants = [self.tenants[0], self.tenants[1].pk]
+        with self.assertNumQueries(1):
+            names = set(TestModel.objects.by_tenants(tenants).values_list('name', flat=True))
+        self.assertEqual(names, {self.tenants[0].name, self.tenants[1].name})
+        self.assertEqual(TestModel.objects.by_tenants(iter([])).count(), 0)
+
+    def test_by_group(self):
+        with self.assertNumQueries(1):
+            count = TestModel.objects.by_group(self.group).filter(name__isnull=False).count()
+        self.assertEqual(count, 3)
+        self.assertEqual(TestModel.objects.by_group(self.group.pk).count(), 3)
+
+    def test_creates_need_a_single_tenant(self):
+        for qs in (TestModel.objects.by_tenants(self.tenants), TestModel.objects.by_group(self.group)):
+            with self.assertRaises(MultitenantIncompatiblityError):
+                qs.create(name='new')
+            with self.assertRaises(MultitenantIncompatiblityError):
+                qs.get_or_create(name='new')
+            with self.assertRaises(MultitenantIncompatiblityError):
+                qs.bulk_create([TestModel(name='new')])
+        self.assertEqual(TestModel.all_tenants.filter(name='new').count(), 0)
+
+    def test_create_with_exactly_one_tenant(self):
+        instance = TestModel.objects.by_tenants([self.tenants[0]]).create(name='new')
+        self.assertEqual(instance.tenant_id, self.tenants[0].pk)
+
+
+class TenantBulkCreateIterTest(TestCase):
+
+    def setUp(self):
+        self.tenant, self.other_tenant = mommy.make('Tenant', _quantity=2)
+
+    def test_generator_inserted_in_batches(self):
+        objs = (TestModel(name='obj-%d' % i) for i in range(25))
+        with CaptureQueriesContext(connection) as context:
+            count = TestModel.objects.by_tenant(self.tenant.pk).bulk_create_iter(objs, batch_size=10)
+        self.assertEqual(count, 25)
+        inserts = [q for q in context.captured_queries if 'INSERT INTO' in q['sql']]
+        self.assertEqual(len(inserts), 3)
+        self.assertEqual(TestModel.objects.by_tenant(self.tenant).count(), 25)
+
+    def test_batches_are_consumed_lazily(self):
+        def objs():
+            for i in range(5):
+                # only the objects of the batch being built aren't inserted yet
+                self.assertEqual(TestModel.all_tenants.count(), i - i % 2)
+                yield TestModel(name='obj-%d' % i)
+
+        count = TestModel.objects.by_tenant(self.tenant).bulk_create_iter(objs(), batch_size=2)
+        self.assertEqual(count, 5)
+
+    def test_wrong_tenant_rolls_back_all_batches(self):
+        objs = [TestModel(name='one'), TestModel(name='two'),
+                TestModel(name='three', tenant_id=self.other_tenant.pk)]
+        with self.assertRaises(MultitenantIncompatiblityError):
+            TestModel.objects.by_tenant(self.tenant).bulk_create_iter(objs, batch_size=2)
+        self.assertEqual(TestModel.all_tenants.count(), 0)
+
+    def test_needs_a_single_tenant(self):
+        with self.assertRaises(MultitenantIncompatiblityError):
+            TestModel.objects.by_group(self.tenant.group).bulk_create_iter([TestModel(name='one')])
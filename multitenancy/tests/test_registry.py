@@ -0,0 +1,81 @@
+import time
+
+from django.core.cache import caches
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from mock import patch
+from model_mommy import mommy
+
+from ..models import Tenant
+from ..registry import TenantRegistry
+
+
+@override_settings(MULTITENANCY_CACHE='default')
+class SharedRegistryTest(TestCase):
+    """TenantRegistry shared between processes through the cache framework."""
+
+    def setUp(self):
+        caches['default'].clear()
+        self.group = mommy.make('TenantGroup')
+        self.tenant = mommy.make('Tenant', group=self.group)
+        # Each registry stands in for a registry in a different worker process
+        self.registry = TenantRegistry()
+        self.other_registry = TenantRegistry()
+
+    def test_entries_are_shared(self):
+        self.registry.get_tenant(self.group.slug, self.tenant.slug)
+        with self.assertNumQueries(0):
+            tenant = self.other_registry.get_tenant(self.group.slug, self.tenant.slug)
+        self.assertEqual(tenant, self.tenant)
+        self.assertEqual(tenant.group, self.group)
+
+    def test_misses_are_shared(self):
+        self.assertIsNone(self.registry.get_group('missing'))
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.other_registry.get_group('missing'))
+
+    def test_changes_invalidate_other_processes(self):
+        self.assertEqual(self.other_registry.get_group(self.group.slug), self.group)
+        old_slug = self.group.slug
+        self.group.slug = 'renamed'
+        self.group.save()
+        self.assertIsNone(self.other_registry.get_group(old_slug))
+        self.assertEqual(self.other_registry.get_group('renamed'), self.group)
+
+    def test_tenant_group_id(self):
+        self.assertEqual(self.registry.get_tenant_group_id(self.tenant.pk), self.group.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.other_registry.get_tenant_group_id(self.tenant.pk), self.group.pk)
+        other_group = mommy.make('TenantGroup')
+        self.tenant.group = other_group
+        self.tenant.save()
+        self.assertEqual(self.other_registry.get_tenant_group_id(self.tenant.pk), other_group.pk)
+
+
+class LocalRegistryTest(TestCase):
+    """Without a shared cache, entries expire so that other processes' changes are seen."""
+
+    def setUp(self):
+        self.group, self.other_group = mommy.make('TenantGroup', _quantity=2)
+        self.tenant = mommy.make('Tenant', group=self.group)
+        self.registry = TenantRegistry()
+
+    def move_tenant_in_other_process(self):
+        # update() sends no signals, as if the change was made by another process
+        Tenant.objects.filter(pk=self.tenant.pk).update(group=self.other_group)
+
+    def test_entries_kept_until_timeout(self):
+        self.assertEqual(self.registry.get_tenant_group_id(self.tenant.pk), self.group.pk)
+        self.move_tenant_in_other_process()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.registry.get_tenant_group_id(self.tenant.pk), self.group.pk)
+        with patch('time.time', return_value=time.time() + 61):
+            self.assertEqual(self.registry.get_tenant_group_id(self.tenant.pk), self.other_group.pk)
+
+    @override_settings(MULTITENANCY_LOCAL_CACHE_TIMEOUT=None)
+    def test_timeout_can_be_disabled(self):
+        self.registry.get_tenant_group_id(self.tenant.pk)
+        self.move_tenant_in_other_process()
+        with patch('time.time', return_value=time.time() + 3600):
+            self.assertEqual(self.registry.get_tenant_group_id(self.tenant.pk), self.group.pk)
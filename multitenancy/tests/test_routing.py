@@ -0,0 +1,229 @@
+import time
+
+from django.core.cache import caches
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+
+from mock import patch
+from model_mommy import mommy
+from rapidsms.messages.incoming import IncomingMessage
+
+from ..app import TenantApp
+from ..cache import get_version
+from ..models import BackendLink, Tenant
+from ..routing import ResolvedIdentity, identity_resolver, routing_table
+
+
+class BackendRoutingTableTest(TestCase):
+
+    def setUp(self):
+        self.tenant = mommy.make('Tenant')
+        self.tester = mommy.make('Backend', name='mt_tester')
+        self.backend = mommy.make('Backend', name='external')
+        mommy.make('BackendLink', backend=self.tester, tenant=self.tenant)
+        mommy.make('BackendLink', backend=self.backend, tenant=self.tenant)
+
+    def test_primary_backend_skips_message_tester(self):
+        self.assertEqual(routing_table.get_primary_backend(self.tenant.pk), self.backend)
+        self.assertEqual(routing_table.get_backends(self.tenant.pk), [self.tester, self.backend])
+
+    def test_lookups_are_served_from_the_table(self):
+        other = mommy.make('Tenant')
+        routing_table.get_backends(self.tenant.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(routing_table.get_primary_backend(self.tenant.pk), self.backend)
+            self.assertIsNone(routing_table.get_primary_backend(other.pk))
+
+    def test_primary_backend_property(self):
+        tenant = Tenant.objects.get(pk=self.tenant.pk)
+        # The first lookup builds the table with a single query ...
+        with self.assertNumQueries(1):
+            self.assertEqual(tenant.primary_backend, self.backend)
+        # ... after which other instances don't need any
+        tenant = Tenant.objects.get(pk=self.tenant.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(tenant.primary_backend, self.backend)
+
+    def test_new_link_updates_table(self):
+        other = mommy.make('Tenant')
+        self.assertIsNone(routing_table.get_primary_backend(other.pk))
+        backend = mommy.make('Backend', name='other')
+        mommy.make('BackendLink', backend=backend, tenant=other)
+        self.assertEqual(routing_table.get_primary_backend(other.pk), backend)
+
+    def test_add_backend_updates_table(self):
+        other = mommy.make('Tenant')
+        self.assertIsNone(routing_table.get_primary_backend(other.pk))
+        backend = mommy.make('Backend', name='other')
+        other.add_backend(backend)
+        self.assertEqual(routing_table.get_primary_backend(other.pk), backend)
+
+    def test_tenant_save_updates_table(self):
+        self.assertEqual(routing_table.get_primary_backend(self.tenant.pk), self.backend)
+        self.tenant.save()
+        # saving a tenant without unsaved_backendlinks clears its links
+        self.assertIsNone(routing_table.get_primary_backend(self.tenant.pk))
+
+    def test_other_processes_changes_seen_after_timeout(self):
+        other = mommy.make('Tenant')
+        self.assertEqual(routing_table.get_primary_backend(self.tenant.pk), self.backend)
+        # update() sends no signals, as if the link was moved by another process
+        BackendLink.all_tenants.filter(backend=self.backend).update(tenant=other)
+        self.assertEqual(routing_table.get_primary_backend(self.tenant.pk), self.backend)
+        self.addCleanup(routing_table.invalidate)
+        with patch('time.time', return_value=time.time() + 61):
+            self.assertIsNone(routing_table.get_primary_backend(self.tenant.pk))
+            self.assertEqual(routing_table.get_primary_backend(other.pk), self.backend)
+
+    def test_tenant_of_backend(self):
+        unlinked = mommy.make('Backend', name='unlinked')
+        mommy.make('BackendLink', backend=unlinked)
+        self.assertEqual(routing_table.get_tenant_id(backend_id=self.backend.pk), self.tenant.pk)
+        self.assertEqual(routing_table.get_tenant_id(backend_name='mt_tester'), self.tenant.pk)
+        self.assertIsNone(routing_table.get_tenant_id(backend_id=unlinked.pk))
+        self.assertIsNone(routing_table.get_tenant_id(backend_name='missing'))
+        tenant = routing_table.get_tenant(self.tenant.pk)
+        self.assertEqual(tenant, self.tenant)
+        self.assertEqual(tenant.group, self.tenant.group)
+
+
+class TenantAppTest(TestCase):
+
+    def setUp(self):
+        self.tenant = mommy.make('Tenant')
+        self.backend = mommy.make('Backend', name='external')
+        mommy.make('BackendLink', backend=self.backend, tenant=self.tenant)
+        self.app = TenantApp(router=None)
+
+    def test_message_is_tagged_with_tenant(self):
+        connection = mommy.make('Connection', backend=self.backend)
+        msg = IncomingMessage(connections=[connection], text='hello')
+        routing_table.get_tenant_id(backend_id=self.backend.pk)
+        with self.assertNumQueries(0):
+            self.app.filter(msg)
+            self.assertEqual(msg.tenant_id, self.tenant.pk)
+            self.assertEqual(msg.tenant.group, self.tenant.group)
+
+    def test_backend_without_tenant(self):
+        connection = mommy.make('Connection', backend=mommy.make('Backend', name='other'))
+        msg = IncomingMessage(connections=[connection], text='hello')
+        self.app.filter(msg)
+        self.assertIsNone(msg.tenant_id)
+        self.assertIsNone(msg.tenant)
+
+
+class TenantAppOtherProcessTest(TestCase):
+    """The router process sees backends linked by other processes."""
+
+    def setUp(self):
+        self.tenant = mommy.make('Tenant')
+        self.backend = mommy.make('Backend', name='external')
+        self.app = TenantApp(router=None)
+        self.msg = IncomingMessage(connections=[mommy.make('Connection', backend=self.backend)], text='hello')
+        self.addCleanup(routing_table.invalidate)
+
+    def link_in_other_process(self):
+        """Link the backend without sending signals in this process."""
+        BackendLink.all_tenants.bulk_create([BackendLink(backend=self.backend, tenant=self.tenant)])
+
+    @override_settings(MULTITENANCY_CACHE='default')
+    def test_shared_version_bumped_by_other_process(self):
+        caches['default'].clear()
+        self.app.filter(self.msg)
+        self.assertIsNone(self.msg.tenant_id)
+        self.link_in_other_process()
+        # the other process bumps the shared version directly
+        caches['default'].incr('multitenancy:version:{}'.format(routing_table.version_name))
+        self.app.filter(self.msg)
+        self.assertEqual(self.msg.tenant_id, self.tenant.pk)
+        self.assertEqual(self.msg.tenant, self.tenant)
+
+    def test_local_table_expires(self):
+        self.app.filter(self.msg)
+        self.assertIsNone(self.msg.tenant_id)
+        self.link_in_other_process()
+        self.app.filter(self.msg)
+        self.assertIsNone(self.msg.tenant_id)
+        with patch('time.time', return_value=time.time() + 61):
+            self.app.filter(self.msg)
+        self.assertEqual(self.msg.tenant_id, self.tenant.pk)
+
+
+class IdentityResolverTest(TestCase):
+
+    def setUp(self):
+        self.tenant = mommy.make('Tenant')
+        self.backend = mommy.make('Backend', name='external')
+        mommy.make('BackendLink', backend=self.backend, tenant=self.tenant)
+        self.contact = mommy.make('Contact')
+        self.contact_link = mommy.make('ContactLink', contact=self.contact, tenant=self.tenant)
+        self.connection = mommy.make('Connection', backend=self.backend, identity='1111',
+                                     contact=self.contact)
+        self.anonymous = mommy.make('Connection', backend=self.backend, identity='2222')
+
+    def test_resolve_batch_with_one_query(self):
+        with self.assertNumQueries(1):
+            results = identity_resolver.resolve([
+                (self.backend, '1111'),
+                ('external', '2222'),
+                ('external', '3333'),
+                ('missing', '1111'),
+            ])
+        self.assertEqual(results, [
+            ResolvedIdentity(self.tenant.pk, self.contact.pk, self.contact_link.pk),
+            ResolvedIdentity(self.tenant.pk, None, None),
+            None,
+            None,
+        ])
+
+    def test_repeat_senders_are_cached(self):
+        identity_resolver.resolve([('external', '1111')])
+        with self.assertNumQueries(0):
+            result, = identity_resolver.resolve([('external', '1111')])
+        self.assertEqual(result.contact_id, self.contact.pk)
+
+    def test_contact_change_invalidates_cache(self):
+        identity_resolver.resolve([('external', '2222')])
+        self.anonymous.contact = self.contact
+        self.anonymous.save()
+        result, = identity_resolver.resolve([('external', '2222')])
+        self.assertEqual(result.contact_id, self.contact.pk)
+
+    def test_backend_rename_invalidates_cache(self):
+        identity_resolver.resolve([('external', '1111')])
+        self.backend.name = 'renamed'
+        self.backend.save()
+        self.assertEqual(identity_resolver.resolve([('external', '1111')]), [None])
+        result, = identity_resolver.resolve([('renamed', '1111')])
+        self.assertEqual(result.tenant_id, self.tenant.pk)
+
+    def test_backend_link_change_invalidates_cache(self):
+        identity_resolver.resolve([('external', '1111')])
+        BackendLink.all_tenants.filter(backend=self.backend).get().delete()
+        result, = identity_resolver.resolve([('external', '1111')])
+        self.assertIsNone(result.tenant_id)
+
+    def test_tenant_delete_invalidates_cache(self):
+        identity_resolver.resolve([('external', '1111')])
+        self.tenant.delete()
+        result, = identity_resolver.resolve([('external', '1111')])
+        self.assertIsNone(result.tenant_id)
+
+
+class BackendLinksCommitTest(TransactionTestCase):
+    """Data cached by other processes before changed links are committed isn't kept."""
+
+    def setUp(self):
+        caches['default'].clear()
+        self.tenant = mommy.make('Tenant')
+        self.link = mommy.make('BackendLink', backend=mommy.make('Backend', name='external'))
+
+    def test_versions_bumped_after_commit(self):
+        with transaction.atomic():
+            self.tenant.unsaved_backendlinks = [self.link]
+            self.tenant.save()
+            versions = [get_version(cached.version_name)
+                        for cached in (routing_table, identity_resolver)]
+        self.assertNotEqual(get_version(routing_table.version_name), versions[0])
+        self.assertNotEqual(get_version(identity_resolver.version_name), versions[1])
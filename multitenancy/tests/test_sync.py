@@ -0,0 +1,118 @@
+import shutil
+import tempfile
+
+from django.apps import apps
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from mock import patch
+from model_mommy import mommy
+
+from ..models import BackendLink
+from ..sync import get_fingerprint, sync_backend_links, sync_backend_links_if_changed
+
+
+class SyncBackendLinksTest(TestCase):
+
+    def test_returns_added_names_in_order(self):
+        mommy.make('BackendLink', backend=mommy.make('Backend', name='b'))
+        self.assertEqual(sync_backend_links(['c', 'b', 'a', 'c']), ['c', 'a'])
+        self.assertEqual(sorted(BackendLink.all_tenants.values_list('backend__name', flat=True)),
+                         ['a', 'b', 'c'])
+
+    def test_dry_run(self):
+        self.assertEqual(sync_backend_links(['a'], dry_run=True), ['a'])
+        self.assertFalse(BackendLink.all_tenants.exists())
+
+    def test_fingerprint_ignores_order(self):
+        self.assertEqual(get_fingerprint(['a', 'b']), get_fingerprint(['b', 'a']))
+        self.assertNotEqual(get_fingerprint(['a', 'b']), get_fingerprint(['a']))
+
+
+class SharedCacheMixin(object):
+    """Use a file based cache, which is shared between processes, as MULTITENANCY_CACHE."""
+
+    def setUp(self):
+        super(SharedCacheMixin, self).setUp()
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        override = override_settings(
+            CACHES={
+                'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                'shared': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                           'LOCATION': location},
+            },
+            MULTITENANCY_CACHE='shared',
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+
+
+class SyncIfChangedTest(TestCase):
+
+    def test_requires_shared_cache(self):
+        with self.assertRaises(ImproperlyConfigured):
+            sync_backend_links_if_changed(['a'])
+        with self.settings(MULTITENANCY_CACHE='default'):
+            # the local memory cache isn't shared between processes
+            with self.assertRaises(ImproperlyConfigured):
+                sync_backend_links_if_changed(['a'])
+        self.assertFalse(BackendLink.all_tenants.exists())
+
+
+class SharedSyncIfChangedTest(SharedCacheMixin, TestCase):
+
+    def test_skipped_when_unchanged(self):
+        self.assertEqual(sync_backend_links_if_changed(['a', 'b']), ['a', 'b'])
+        with self.assertNumQueries(0):
+            self.assertIsNone(sync_backend_links_if_changed(['b', 'a']))
+
+    def test_synced_when_changed(self):
+        sync_backend_links_if_changed(['a'])
+        self.assertEqual(sync_backend_links_if_changed(['a', 'b']), ['b'])
+
+    def test_skipped_while_locked(self):
+        with patch.object(caches['shared'], 'add', return_value=False):
+            with self.assertNumQueries(0):
+                self.assertIsNone(sync_backend_links_if_changed(['a']))
+        self.assertFalse(BackendLink.all_tenants.exists())
+        # the fingerprint wasn't stored, so the next process syncs
+        self.assertEqual(sync_backend_links_if_changed(['a']), ['a'])
+
+    def test_lock_released_on_error(self):
+        with patch('multitenancy.sync.sync_backend_links', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                sync_backend_links_if_changed(['a'])
+        self.assertEqual(sync_backend_links_if_changed(['a']), ['a'])
+
+
+class StartupSyncTest(SharedCacheMixin, TestCase):
+
+    def ready(self):
+        apps.get_app_config('multitenancy').ready()
+
+    def test_off_by_default(self):
+        with self.settings(INSTALLED_BACKENDS={'a': {}}):
+            self.ready()
+        self.assertFalse(BackendLink.all_tenants.exists())
+
+    @override_settings(MULTITENANCY_SYNC_BACKEND_LINKS=True)
+    def test_syncs_installed_backends(self):
+        with self.settings(INSTALLED_BACKENDS={'a': {}}):
+            self.ready()
+        self.assertTrue(BackendLink.all_tenants.filter(backend__name='a').exists())
+
+    @override_settings(MULTITENANCY_SYNC_BACKEND_LINKS=True)
+    def test_database_errors_dont_prevent_startup(self):
+        with patch('multitenancy.sync.sync_backend_links_if_changed', side_effect=DatabaseError):
+            with patch('multitenancy.sync.logger') as logger:
+                self.ready()
+        self.assertTrue(logger.warning.called)
+
+    @override_settings(MULTITENANCY_SYNC_BACKEND_LINKS=True, MULTITENANCY_CACHE=None)
+    def test_refuses_to_start_without_shared_cache(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self.ready()
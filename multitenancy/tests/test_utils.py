@@ -0,0 +1,51 @@
+from django.test import SimpleTestCase
+
+import mock
+
+from ..utils import LRUCache
+
+
+class LRUCacheTest(SimpleTestCase):
+
+    def test_get_and_set(self):
+        cache = LRUCache(max_size=2)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('a', 'default'), 'default')
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # using 'a' makes 'b' the least recently used
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_clear(self):
+        cache = LRUCache()
+        cache.set('a', 1)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_timeout(self):
+        cache = LRUCache(timeout=60)
+        with mock.patch('multitenancy.utils.time.time', return_value=1000):
+            cache.set('a', 1)
+        with mock.patch('multitenancy.utils.time.time', return_value=1059):
+            self.assertEqual(cache.get('a'), 1)
+        with mock.patch('multitenancy.utils.time.time', return_value=1060):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_hit_and_miss_counters(self):
+        cache = LRUCache()
+        cache.get('a')
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('a')
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
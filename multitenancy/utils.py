@@ -0,0 +1,67 @@
+from __future__ import unicode_literals
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A small, thread-safe, size bounded least-recently-used cache.
+
+    If timeout (in seconds) is given, entries also expire that long after being set.
+    The number of hits and misses is counted, to help tune max_size and timeout.
+    """
+
+    def __init__(self, max_size=128, timeout=None):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= time.time():
+                self.misses += 1
+                return default
+            # Re-insert to mark as most recently used
+            self._data[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = time.time() + self.timeout if self.timeout is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+
+def instance_values(instance):
+    """Return a picklable snapshot of a model instance, for use with build_instance."""
+    values = dict((f.attname, getattr(instance, f.attname)) for f in instance._meta.concrete_fields)
+    return values, instance._state.db
+
+
+def build_instance(model, entry):
+    """Return a new instance of model from a snapshot made by instance_values."""
+    values, db = entry
+    instance = model(**values)
+    instance._state.adding = False
+    instance._state.db = db
+    return instance
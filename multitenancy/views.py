@@ -1,7 +1,17 @@
 from django.contrib.auth.decorators import login_required
-from django.shortcuts import render, redirect, get_object_or_404
+from django.http import Http404
+from django.shortcuts import render, redirect
 
-from .auth import get_user_groups, get_user_tenants
+from .auth import can_access_group, can_access_tenant, get_user_groups, get_user_tenants
+from .registry import registry
+
+
+def get_group_or_404(user, group_slug):
+    """Return the TenantGroup for the slug if the user has access to it."""
+    group = registry.get_group(group_slug)
+    if group is None or not can_access_group(user, group.pk):
+        raise Http404('No TenantGroup matches the given query.')
+    return group
 
 
 @login_required
@@ -23,8 +33,7 @@ def group_selection(request):
 @login_required
 def group_dashboard(request, group_slug):
     """Dashboard for managing a TenantGroup."""
-    groups = get_user_groups(request.user)
-    group = get_object_or_404(groups, slug=group_slug)
+    group = get_group_or_404(request.user, group_slug)
     tenants = get_user_tenants(request.user, group)
     can_edit_group = request.user.has_perm('multitenancy.change_tenantgroup', group)
     count = len(tenants)
@@ -43,10 +52,10 @@ def group_dashboard(request, group_slug):
 @login_required
 def tenant_dashboard(request, group_slug, tenant_slug):
     """Dashboard for managing a tenant."""
-    groups = get_user_groups(request.user)
-    group = get_object_or_404(groups, slug=group_slug)
-    tenants = get_user_tenants(request.user, group)
-    tenant = get_object_or_404(tenants, slug=tenant_slug)
+    group = get_group_or_404(request.user, group_slug)
+    tenant = registry.get_tenant(group_slug, tenant_slug)
+    if tenant is None or tenant.group_id != group.pk or not can_access_tenant(request.user, tenant):
+        raise Http404('No Tenant matches the given query.')
     can_edit_tenant = request.user.has_perm('multitenancy.change_tenant', tenant)
     context = {
         'group': group,